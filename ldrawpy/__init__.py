@@ -16,9 +16,46 @@ from .ldrawpy import brick_name_strip, xyz_to_ldr, mesh_to_ldr
 from .ldrcolourdict import *
 from .ldrhelpers import *
 from .ldrcolour import LDRColour
+from .ldrrotation import (
+    RotationCache,
+    ROTATION_CACHE,
+    euler_rotation,
+    rotation_matrix,
+    rotation_array,
+    rotation_cache_stats,
+    shared_matrix,
+)
 from .ldrprimitives import LDRAttrib, LDRHeader, LDRLine, LDRTriangle, LDRQuad, LDRPart
+from .ldrparttable import PartTable, CumulativeParts, CumulativePartsView
+from .ldrstep import LDRStep, LDRUnwrappedStep, StepPLI
 from .ldrshapes import *
-from .ldrmodel import LDRModel, parse_special_tokens, sort_parts, get_sha1_hash
+from .ldrindex import LDRFileIndex, CalloutIndex, UnwrappedIndex
+from .ldralias import PartAliases, alias_name
+from .ldrcache import ParseCache, file_hash
+from .ldrmeta import MetaCommandMatcher, register_special_token
+from .ldrmodel import (
+    LDRModel,
+    parse_special_tokens,
+    sort_parts,
+    get_sha1_hash,
+    part_record,
+    iter_flattened_parts,
+    flatten_model,
+    FlattenCache,
+    iter_recursive_parts,
+    read_model_parts,
+    scan_ldraw,
+    SubmodelGraph,
+    file_part_counts,
+    scan_model_parts,
+    PART_ALIASES,
+)
+from .ldrpartfile import (
+    PartFile,
+    write_part_file,
+    write_model_part_file,
+    PART_FILE_EXT,
+)
 from .ldvrender import LDViewRender
 from .ldrarrows import ArrowContext, arrows_for_step, remove_offset_parts
 from .ldrpprint import pprint_line, clean_line, clean_file
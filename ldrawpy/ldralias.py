@@ -0,0 +1,247 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2020  Michael Gale
+# This file is part of the legocad python module.
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+# LDraw part alias resolution
+
+import hashlib
+import os
+
+# the first line of an LDraw library part which has been renamed
+MOVED_TO = "~moved to"
+
+
+def alias_name(name):
+    """Returns a part name normalized for alias lookups, i.e. lower case
+    without the .dat extension."""
+    name = " ".join(name.lower().split())
+    return name[:-4] if name.endswith(".dat") else name
+
+
+class PartAliases:
+    """A compiled map of part name aliases with the sets of ignored and
+    exception part names.  Aliases are resolved transitively, e.g. with the
+    aliases a -> b and b -> c, a resolves to c regardless of the order in
+    which the aliases were added.  Adding an alias which would create a
+    cycle raises a ValueError.  Resolved names are cached until the aliases
+    are changed so that every lookup is a single dictionary access.
+
+    Aliases can be added from a list of (name, alias) pairs, a dictionary,
+    a user table file or the "~Moved to" parts of an LDraw library.  The
+    map can also track lists of aliases, ignored and exception parts so
+    that changes made to the lists are applied when it is refreshed."""
+
+    def __init__(self, aliases=None, ignore=None, exceptions=None):
+        self.aliases = {}
+        self.ignore = set(ignore) if ignore is not None else set()
+        self.exceptions = set(exceptions) if exceptions is not None else set()
+        self._resolved = {}
+        self._sources = None
+        self._source_state = None
+        if aliases is not None:
+            self.update(aliases)
+
+    def __len__(self):
+        return len(self.aliases)
+
+    def __contains__(self, name):
+        return name in self.aliases
+
+    def __str__(self):
+        return "PartAliases: %d aliases, %d ignored, %d exceptions" % (
+            len(self.aliases),
+            len(self.ignore),
+            len(self.exceptions),
+        )
+
+    def __getstate__(self):
+        # the lookup cache is not pickled, e.g. when stored in the parse cache
+        state = dict(self.__dict__)
+        state["_resolved"] = {}
+        return state
+
+    def copy(self):
+        return PartAliases(self.aliases, self.ignore, self.exceptions)
+
+    def clear_cache(self):
+        self._resolved = {}
+
+    @staticmethod
+    def _check(aliases, name, alias):
+        # raises a ValueError if adding name -> alias to a dictionary of
+        # aliases would create a cycle
+        chain = [name, alias]
+        target = alias
+        while target in aliases or target == name:
+            if target == name:
+                raise ValueError(
+                    "Part aliases contain a cycle: %s" % (" -> ".join(chain))
+                )
+            target = aliases[target]
+            chain.append(target)
+
+    def add(self, name, alias):
+        """Adds (or replaces) the alias of a part name."""
+        name, alias = alias_name(name), alias_name(alias)
+        self._check(self.aliases, name, alias)
+        self.aliases[name] = alias
+        self._resolved = {}
+
+    def update(self, aliases):
+        """Adds aliases from a dictionary or a list of (name, alias) pairs.
+        The aliases are checked as a batch before any are added, so if one
+        of them would create a cycle, a ValueError is raised and the
+        existing aliases are left unchanged."""
+        if isinstance(aliases, (dict, PartAliases)):
+            aliases = aliases.items()
+        candidate = dict(self.aliases)
+        for name, alias in aliases:
+            name, alias = alias_name(name), alias_name(alias)
+            self._check(candidate, name, alias)
+            candidate[name] = alias
+        self.aliases = candidate
+        self._resolved = {}
+
+    def track(self, aliases, ignore, exceptions):
+        """Tracks a list of (name, alias) pairs, a list of ignored part names
+        and a list of exception part names whose current entries have
+        already been added.  Changes made to the lists are applied by
+        refresh."""
+        self._sources = (aliases, ignore, exceptions)
+        self._source_state = self._tracked_state()
+
+    def _tracked_state(self):
+        aliases, ignore, exceptions = self._sources
+        return (
+            tuple([tuple(e) for e in aliases]),
+            tuple(ignore),
+            tuple(exceptions),
+        )
+
+    def refresh(self):
+        """Applies any changes made to the tracked lists since they were
+        last applied.  Aliases, ignored and exception parts which were not
+        added from the lists are kept.  A ValueError is raised if the
+        changed aliases contain a cycle, and the map is left unchanged.
+        Returns True if the lists had changed."""
+        if self._sources is None:
+            return False
+        state = self._tracked_state()
+        if state == self._source_state:
+            return False
+        old_aliases, old_ignore, old_exceptions = self._source_state
+        new_aliases, new_ignore, new_exceptions = state
+        old = {alias_name(k): alias_name(v) for k, v in old_aliases}
+        added = [(k, v) for k, v in self.aliases.items() if not old.get(k) == v]
+        candidate = {}
+        for name, alias in list(new_aliases) + added:
+            name, alias = alias_name(name), alias_name(alias)
+            self._check(candidate, name, alias)
+            candidate[name] = alias
+        self.aliases = candidate
+        self.ignore = (self.ignore - set(old_ignore)) | set(new_ignore)
+        self.exceptions = (self.exceptions - set(old_exceptions)) | set(new_exceptions)
+        self._source_state = state
+        self._resolved = {}
+        return True
+
+    def items(self):
+        return self.aliases.items()
+
+    def load(self, filename):
+        """Adds aliases from a text file with a part name and its alias on
+        each line separated by whitespace or a comma.  Blank lines and
+        lines starting with # are skipped.  The whole file is read before
+        any aliases are added, so an invalid file adds none of them.
+        Returns the number of aliases added."""
+        pairs = []
+        with open(filename, "rt") as fp:
+            for line in fp:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                fields = line.replace(",", " ").split()
+                if not len(fields) == 2:
+                    raise ValueError("Invalid part alias in %s: %s" % (filename, line))
+                pairs.append(fields)
+        self.update(pairs)
+        return len(pairs)
+
+    def scan_library(self, path):
+        """Adds an alias for every part of an LDraw library which has been
+        moved to a new name, i.e. whose first line is "0 ~Moved to <name>".
+        path is either the library folder or its parts folder.  Only the
+        first line of each part file is read, and the aliases are only
+        added once every part has been read.  Returns the number of
+        aliases added."""
+        path = os.path.expanduser(path)
+        if os.path.isdir(os.path.join(path, "parts")):
+            path = os.path.join(path, "parts")
+        moved = {}
+        for fn in os.listdir(path):
+            if not fn.lower().endswith(".dat"):
+                continue
+            with open(os.path.join(path, fn), "rt", errors="replace") as fp:
+                line = fp.readline().strip()
+            if not line.startswith("0"):
+                continue
+            desc = line[1:].strip()
+            if desc.lower().startswith(MOVED_TO):
+                moved[fn] = desc[len(MOVED_TO) :]
+        self.update(moved)
+        return len(moved)
+
+    def resolve(self, name):
+        """Returns the name a part name resolves to after following all of
+        its aliases."""
+        while name in self.aliases:
+            name = self.aliases[name]
+        return name
+
+    def lookup(self, name):
+        """Returns the resolved name of a part or None if the resolved part
+        is ignored.  Results are cached."""
+        if name in self._resolved:
+            return self._resolved[name]
+        resolved = self.resolve(name)
+        if resolved in self.ignore or resolved.upper() in self.ignore:
+            resolved = None
+        self._resolved[name] = resolved
+        return resolved
+
+    def is_ignored(self, name):
+        return self.lookup(name) is None
+
+    def is_exception(self, name):
+        return name in self.exceptions
+
+    def digest(self):
+        """Returns a hex digest of the aliases, ignored and exception parts,
+        e.g. to identify cached results which depend on them."""
+        h = hashlib.sha1()
+        for name, alias in sorted(self.aliases.items()):
+            h.update(("%s %s\n" % (name, alias)).encode())
+        for e in sorted(self.ignore):
+            h.update(("-%s\n" % (e)).encode())
+        for e in sorted(self.exceptions):
+            h.update(("+%s\n" % (e)).encode())
+        return h.hexdigest()
@@ -30,6 +30,7 @@ from functools import reduce
 import rich
 from toolbox import *
 from ldrawpy import *
+from .ldrrotation import ROTATION_CACHE
 
 ARROW_PREFIX = """0 BUFEXCHG A STORE"""
 ARROW_PLI = """0 !LPUB PLI BEGIN IGN"""
@@ -48,6 +49,26 @@ ARROW_MY = Matrix([[0, -1, 0], [0, 0, -1], [1, 0, 0]])
 ARROW_PY = Matrix([[0, -1, 0], [0, 0, 1], [-1, 0, 0]])
 
 
+ARROW_MATRICES = {
+    "mx": ARROW_MX,
+    "px": ARROW_PX,
+    "my": ARROW_MY,
+    "py": ARROW_PY,
+    "mz": ARROW_MZ,
+    "pz": ARROW_PZ,
+}
+
+
+def arrow_matrix(direction, angle):
+    """Returns a new Matrix for an arrow direction rotated by angle about the
+    Z axis.  The rotated matrices are computed once in the rotation cache."""
+    key = ("arrow", direction, round(float(angle), 4))
+    entry = ROTATION_CACHE.get(
+        key, lambda: ARROW_MATRICES[direction].rotate(key[2], ZAxis)
+    )
+    return Matrix([list(r) for r in entry.rows])
+
+
 def value_after_token(tokens, value_token, x, xtype=int):
     for i, token in enumerate(tokens):
         if not token == value_token or not (i + 1) < len(tokens):
@@ -104,19 +125,19 @@ class ArrowContext:
             rotxz = rotxz + 180
             rotyz = rotyz + 180
         if (offset.x > 0) and "x" not in mask:
-            return ARROW_MX.rotate(-rotyz + tilt, ZAxis)
+            return arrow_matrix("mx", -rotyz + tilt)
         elif (offset.x < 0) and "x" not in mask:
-            return ARROW_PX.rotate(rotyz + tilt, ZAxis)
+            return arrow_matrix("px", rotyz + tilt)
 
         if (offset.y > 0) and "y" not in mask:
-            return ARROW_PY.rotate(rotxz + tilt, ZAxis)
+            return arrow_matrix("py", rotxz + tilt)
         elif (offset.y < 0) and "y" not in mask:
-            return ARROW_MY.rotate(-rotxz + tilt, ZAxis)
+            return arrow_matrix("my", -rotxz + tilt)
 
         if (offset.z > 0) and "z" not in mask:
-            return ARROW_MZ.rotate(-rotxy + tilt, ZAxis)
+            return arrow_matrix("mz", -rotxy + tilt)
         elif (offset.z < 0) and "z" not in mask:
-            return ARROW_PZ.rotate(rotxy + tilt, ZAxis)
+            return arrow_matrix("pz", rotxy + tilt)
         return Identity()
 
     def loc_for_offset(self, offset, length, mask="", ratio=0.5):
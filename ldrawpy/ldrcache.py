@@ -0,0 +1,208 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2020  Michael Gale
+# This file is part of the legocad python module.
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+# LDraw model parse cache
+
+
+import glob
+import hashlib
+import mmap
+import os
+import pickle
+
+from . import __version__
+
+# the parser version, the package version and a digest of the source of the
+# package modules (which define the layout of the pickled classes, e.g. the
+# slots of LDRStep and LDRPart) are part of every cache key so that results
+# cached by any other version of the code are never loaded
+PARSER_VERSION = 2
+CACHE_EXT = ".ldrcache"
+
+# errors raised when reading, unpickling or restoring an unreadable entry or
+# an entry pickled by another version of the code
+CACHE_ERRORS = (
+    OSError,
+    ValueError,
+    EOFError,
+    pickle.UnpicklingError,
+    AttributeError,
+    ImportError,
+    TypeError,
+    KeyError,
+    IndexError,
+)
+
+_code_digest = None
+
+
+def code_digest():
+    """Returns a hex digest of the package version and the source of the
+    package modules.  It is computed once per process."""
+    global _code_digest
+    if _code_digest is None:
+        h = hashlib.sha1(__version__.encode())
+        path = os.path.dirname(os.path.abspath(__file__))
+        for fn in sorted(glob.glob(os.path.join(path, "*.py"))):
+            try:
+                with open(fn, "rb") as fp:
+                    h.update(os.path.basename(fn).encode())
+                    h.update(fp.read())
+            except OSError:
+                continue
+        _code_digest = h.hexdigest()
+    return _code_digest
+
+
+def file_hash(filename):
+    """Returns the SHA1 hex digest of the contents of a file."""
+    h = hashlib.sha1()
+    with open(filename, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ParseCache:
+    """A directory of parsed LDraw models.  Each entry is a pickled dictionary
+    of parsed results stored in a file named by a cache key derived from
+    the content hash of the LDraw file, the parser version and the parsing
+    parameters.  Entries are read through a memory map and the least recently
+    used entries are removed when the total size of the cache exceeds
+    max_bytes.
+
+    LDRModel stores the columnar part store of each parsed model with the
+    light fields of each step rather than the step records themselves, e.g.
+    an entry for a 56 KB model with 120 root steps and 952 unwrapped steps
+    is about 0.9 MB and is loaded in about 10 ms.  The PLI and parts of each
+    step are only rebuilt when they are accessed, so the saving on a warm
+    load is spread over the first access to the steps."""
+
+    def __init__(self, path, max_bytes=None):
+        self.path = os.path.expanduser(path)
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok=True)
+
+    def __str__(self):
+        return "ParseCache: %s %d entries, %d bytes" % (
+            self.path,
+            len(self),
+            self.size(),
+        )
+
+    def __len__(self):
+        return len(self.entries())
+
+    def __contains__(self, key):
+        return os.path.isfile(self.filename(key))
+
+    @staticmethod
+    def key(content_hash, params=None):
+        """Returns a cache key from the content hash of an LDraw file and a
+        dictionary of the parameters used to parse it."""
+        h = hashlib.sha1()
+        h.update(content_hash.encode())
+        h.update(("v%d" % (PARSER_VERSION)).encode())
+        h.update(code_digest().encode())
+        params = params if params is not None else {}
+        for k in sorted(params):
+            h.update(("%s=%r;" % (k, params[k])).encode())
+        return h.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, key + CACHE_EXT)
+
+    def entries(self):
+        """Returns a list of (filename, size, last used time) of the entries."""
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(CACHE_EXT):
+                fn = os.path.join(self.path, name)
+                try:
+                    st = os.stat(fn)
+                except OSError:
+                    continue
+                entries.append((fn, st.st_size, st.st_mtime))
+        return entries
+
+    def size(self):
+        return sum([e[1] for e in self.entries()])
+
+    def load(self, key):
+        """Returns the cached results for key or None if they are not cached
+        or cannot be read.  An entry which cannot be read is removed."""
+        fn = self.filename(key)
+        if not os.path.isfile(fn):
+            return None
+        try:
+            with open(fn, "rb") as fp:
+                with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    results = pickle.loads(mm)
+            # mark the entry as recently used
+            os.utime(fn)
+        except CACHE_ERRORS:
+            self.remove(key)
+            return None
+        return results
+
+    def remove(self, key):
+        """Removes the entry for key if it exists."""
+        try:
+            os.remove(self.filename(key))
+        except OSError:
+            pass
+
+    def store(self, key, results):
+        """Stores a dictionary of results for key and evicts old entries if
+        the cache exceeds its size limit."""
+        fn = self.filename(key)
+        tmp = fn + ".%d.tmp" % (os.getpid())
+        with open(tmp, "wb") as fp:
+            pickle.dump(results, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, fn)
+        self.evict(keep=fn)
+
+    def evict(self, keep=None):
+        """Removes the least recently used entries until the cache size is
+        within max_bytes.  The entry named keep is never removed."""
+        if self.max_bytes is None:
+            return
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum([e[1] for e in entries])
+        for fn, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if fn == keep:
+                continue
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for fn, _, _ in self.entries():
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
@@ -24,14 +24,77 @@
 # LDraw related helper functions
 
 import decimal
+import re
+from collections.abc import Sequence
 from toolbox import *
 from ldrawpy import *
 
+QUANTUM = decimal.Decimal(10) ** -4
+
+# a plain decimal number with at most 15 digits (which is always exactly
+# representable as a float) split into its whole and fractional digits
+NUMBER_RE = re.compile(r"[+-]?(\d*)(?:\.(\d*))?")
+
+# a type 1 line whose numbers need no rounding, i.e. with at most 4 decimal
+# places and 15 digits, and can therefore be converted directly with float
+PART_NUMBER = r"\s+([+-]?(?:\d{1,11}(?:\.\d{0,4})?|\.\d{1,4}))"
+PART_LINE_RE = re.compile(r"\s*1\s+([+-]?\d+)" + PART_NUMBER * 12 + r"\s+(\S.*)")
+
 
 def quantize(x):
     """Quantizes an string LDraw value to 4 decimal places"""
-    v = decimal.Decimal(x.strip()).quantize(decimal.Decimal(10) ** -4)
-    return float(v)
+    s = x.strip()
+    m = NUMBER_RE.fullmatch(s)
+    if m is not None:
+        whole, frac = m.group(1), m.group(2) or ""
+        if (whole or frac) and len(whole) + len(frac) <= 15:
+            if len(frac) <= 4:
+                return float(s)
+            # round with floats unless the value is exactly half way between
+            # two quanta, since the float value of a tie is inexact
+            tail = frac[4:]
+            if not (tail[0] == "5" and tail[1:].strip("0") == ""):
+                return round(float(s), 4)
+    return float(decimal.Decimal(s).quantize(QUANTUM))
+
+
+def parse_part_line(line):
+    """Decodes a LDraw type 1 line into a tuple of its colour code, a list of
+    its 12 location and matrix values quantized to 4 decimal places and its
+    lower case part name without the .dat extension.  None is returned if the
+    line is not a valid type 1 line."""
+    m = PART_LINE_RE.match(line)
+    if m is not None:
+        g = m.groups()
+        name = " ".join(g[13].lower().split())
+        return int(g[0]), [float(v) for v in g[1:13]], name.replace(".dat", "")
+    split_line = line.split()
+    if not len(split_line) >= 15:
+        return None
+    if not int(split_line[0]) == 1:
+        return None
+    name = " ".join(split_line[14:]).lower()
+    values = [quantize(v) for v in split_line[2:14]]
+    return int(split_line[1]), values, name.replace(".dat", "")
+
+
+def parse_part_lines(lines):
+    """Decodes a batch of LDraw type 1 lines with parse_part_line.  lines can
+    either be a list of strings or a string of line feed delimited lines.
+    The returned list has a decoded tuple (or None) for each line."""
+    if isinstance(lines, str):
+        lines = lines.splitlines()
+    match = PART_LINE_RE.match
+    decoded = []
+    for line in lines:
+        m = match(line)
+        if m is not None:
+            g = m.groups()
+            name = " ".join(g[13].lower().split()).replace(".dat", "")
+            decoded.append((int(g[0]), [float(v) for v in g[1:13]], name))
+        else:
+            decoded.append(parse_part_line(line))
+    return decoded
 
 
 def MM2LDU(x):
@@ -95,16 +158,16 @@ def get_circle_segments(radius, segments, attrib):
 
 
 def ldrlist_from_parts(parts):
-    """Returns a list of LDRPart objects from either a list of LDRParts,
-    a list of strings representing parts or a string with line feed
-    delimited parts."""
+    """Returns a list of LDRPart objects from either a list (or any other
+    sequence such as the parts of a model step) of LDRParts, a list of
+    strings representing parts or a string with line feed delimited parts."""
     from .ldrprimitives import LDRPart
 
     p = []
     if isinstance(parts, str):
         # assume its a string of LDraw lines of text
         parts = parts.splitlines()
-    if isinstance(parts, list):
+    if isinstance(parts, Sequence):
         if len(parts) < 1:
             return p
         if isinstance(parts[0], LDRPart):
@@ -232,6 +295,7 @@ def preset_aspect(current_aspect, aspect_change):
                 new_aspect = (-35, new_aspect[1], new_aspect[2])
     return norm_aspect(new_aspect)
 
+
 def clean_line(line):
     sl = line.split()
     nl = []
@@ -248,6 +312,7 @@ def clean_line(line):
     nl = "".join(nl).rstrip()
     return nl
 
+
 def clean_file(fn, fno=None, verbose=False, as_str=False):
     """Cleans an LDraw file by changing all floating point numbers to
     an optimum representation within the suggested precision of up to
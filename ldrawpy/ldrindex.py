@@ -0,0 +1,258 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2020  Michael Gale
+# This file is part of the legocad python module.
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+# LDraw file segmentation index
+
+import re
+
+# matches the "0 FILE" and "0 STEP" meta commands at the start of a line
+BOUNDARY_RE = re.compile(r"^[ \t]*(?P<cmd>0[ \t]+(?P<kind>FILE|STEP))(?=\s|$)", re.M)
+
+
+class LDRFileIndex:
+    """Single pass index of the FILE and STEP boundaries in LDraw text.
+    The text is scanned once and only character offsets are stored for
+    each file (sub-model) and each step within a file.  The text of a
+    file or step is only sliced from the underlying buffer on demand.
+
+    Files are keyed by their lower case name as declared in the
+    "0 FILE" command.  LDraw text without any "0 FILE" commands is
+    indexed as a single file with an empty name.  As with a MPD file,
+    any text preceding the first "0 FILE" command is not indexed."""
+
+    def __init__(self, text):
+        self.text = text
+        self.names = []
+        self.spans = {}
+        self.steps = {}
+        self._line_starts = {}
+        self._build()
+
+    def __str__(self):
+        return "LDRFileIndex: %d files, %d steps, %d chars" % (
+            len(self.names),
+            sum([len(v) for v in self.steps.values()]),
+            len(self.text),
+        )
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.spans
+
+    def __iter__(self):
+        return iter(self.names)
+
+    @classmethod
+    def from_file(cls, filename):
+        with open(filename, "rt") as fp:
+            return cls(fp.read())
+
+    @property
+    def root(self):
+        """Returns the name of the first (root) file in the index."""
+        return self.names[0]
+
+    def _build(self):
+        text = self.text
+        name, start = "", 0
+        step_start, steps = 0, []
+        has_files = False
+        for m in BOUNDARY_RE.finditer(text):
+            if m.group("kind") == "STEP":
+                steps.append((step_start, m.start("cmd")))
+                step_start = m.end()
+                continue
+            # a new file implicitly closes the previous file and its last step
+            cmd_start = m.start("cmd")
+            if has_files:
+                steps.append((step_start, cmd_start))
+                self._add_file(name, start, cmd_start, steps)
+            has_files = True
+            eol = text.find("\n", m.end())
+            eol = len(text) if eol < 0 else eol
+            name = text[m.end() : eol].lower().strip()
+            start = cmd_start
+            step_start, steps = start, []
+        steps.append((step_start, len(text)))
+        self._add_file(name, start, len(text), steps)
+
+    def _add_file(self, name, start, end, steps):
+        if name not in self.spans:
+            self.names.append(name)
+        self.spans[name] = (start, end)
+        self.steps[name] = steps
+
+    def file_text(self, name):
+        """Returns the LDraw text of a file including its "0 FILE" line."""
+        start, end = self.spans[name]
+        return self.text[start:end]
+
+    def step_spans(self, name=None):
+        """Returns a list of (start, end) offsets for each step of a file.
+        The step text excludes the "0 STEP" command which delimits it."""
+        return self.steps[name if name is not None else self.root]
+
+    def step_texts(self, name=None):
+        """Returns the LDraw text of each step in a file."""
+        text = self.text
+        return [text[s:e] for s, e in self.step_spans(name)]
+
+    def line_starts(self, name=None):
+        """Returns the offsets of the beginning of every line in a file.
+        Line offsets are computed the first time they are requested."""
+        name = name if name is not None else self.root
+        if name not in self._line_starts:
+            start, end = self.spans[name]
+            offsets = [start]
+            pos = self.text.find("\n", start, end)
+            while pos >= 0 and pos + 1 < end:
+                offsets.append(pos + 1)
+                pos = self.text.find("\n", pos + 1, end)
+            self._line_starts[name] = offsets
+        return self._line_starts[name]
+
+
+class CalloutIndex:
+    """Index of the callout ranges of an unwrapped model.  The callouts are
+    provided as the dictionary built by LDRModel.unwrap_model, keyed by the
+    start index into the unwrapped model with the end index, callout level and
+    parent level as values.  The index is built once so that the end, parent,
+    containment and meta tag queries for any step are answered in O(1)."""
+
+    def __init__(self, callouts=None, unwrapped=None):
+        callouts = callouts if callouts is not None else {}
+        unwrapped = unwrapped if unwrapped is not None else []
+        self.ends = set()
+        self.parents = {}
+        self.levels = {}
+        self.tags = {}
+        for start, v in callouts.items():
+            end = v["end"]
+            self.ends.add(end)
+            # the meta tags found anywhere in the callout's range of steps
+            tags = set()
+            for e in unwrapped[start : end + 1]:
+                for m in e["meta"]:
+                    tags.update(m.keys())
+            for i in range(start, end + 1):
+                self.parents[i] = max(self.parents.get(i, 0), v["parent"])
+                self.levels.setdefault(i, set()).add(v["level"])
+                self.tags.setdefault(i, set()).update(tags)
+
+    def __len__(self):
+        return len(self.ends)
+
+    def is_end(self, idx):
+        """Returns True if idx is the last step of a callout."""
+        return idx in self.ends
+
+    def parent(self, idx):
+        """Returns the highest parent level of the callouts containing idx."""
+        return self.parents.get(idx, 0)
+
+    def in_level(self, idx, level):
+        """Returns True if idx is contained in a callout at level."""
+        return idx in self.levels and level in self.levels[idx]
+
+    def has_meta(self, idx, tag):
+        """Returns True if any callout containing idx has a step with tag."""
+        return idx in self.tags and tag in self.tags[idx]
+
+
+class UnwrappedIndex:
+    """Lookup tables for the steps of an unwrapped model as built by
+    LDRModel.unwrap_model.  The unwrapped list is scanned once to index:
+        level_steps - root model step number -> first idx at level 0
+        callout_steps - step number -> first idx which is not in a callout
+        models - sub-model name -> list of idx where the model is built
+        metas - per idx dictionary of meta tag -> (first meta dict, count)
+        model_metas - sub-model name -> meta tag -> first idx with the tag"""
+
+    def __init__(self, unwrapped=None):
+        unwrapped = unwrapped if unwrapped is not None else []
+        self.level_steps = {}
+        self.callout_steps = {}
+        self.models = {}
+        self.metas = []
+        self.model_metas = {}
+        for s in unwrapped:
+            idx = s["idx"]
+            if s["level"] == 0 and s["step"] not in self.level_steps:
+                self.level_steps[s["step"]] = idx
+            if s["callout"] == 0 and s["step"] not in self.callout_steps:
+                self.callout_steps[s["step"]] = idx
+            self.models.setdefault(s["model"], []).append(idx)
+            tags = {}
+            for m in s["meta"]:
+                for tag in m:
+                    if tag in tags:
+                        tags[tag] = (tags[tag][0], tags[tag][1] + 1)
+                    else:
+                        tags[tag] = (m, 1)
+            self.metas.append(tags)
+            model_tags = self.model_metas.setdefault(s["model"], {})
+            for tag in tags:
+                if tag not in model_tags:
+                    model_tags[tag] = idx
+
+    def __len__(self):
+        return len(self.metas)
+
+    def step_idx(self, step, in_callouts=False):
+        """Returns the first idx of a step number or None.  Steps are either
+        matched at the root model level or, if in_callouts is True, for any
+        level which is not part of a callout."""
+        if in_callouts:
+            return self.callout_steps.get(step, None)
+        return self.level_steps.get(step, None)
+
+    def model_last_idx(self, model):
+        """Returns the last idx of a sub-model or 0 if it is not found."""
+        if model in self.models:
+            return max(self.models[model])
+        return 0
+
+    def model_meta_idx(self, model, tag):
+        """Returns the first idx of a sub-model with a meta tag or None."""
+        if model in self.model_metas:
+            return self.model_metas[model].get(tag, None)
+        return None
+
+    def meta(self, idx, tag):
+        """Returns the first meta dictionary with tag at idx or None."""
+        tags = self.metas[idx]
+        if tag in tags:
+            return tags[tag][0]
+        return None
+
+    def meta_count(self, idx, tag):
+        """Returns the number of meta commands with tag at idx."""
+        tags = self.metas[idx]
+        if tag in tags:
+            return tags[tag][1]
+        return 0
+
+    def has_meta(self, idx, tag):
+        return tag in self.metas[idx]
@@ -0,0 +1,119 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2020  Michael Gale
+# This file is part of the legocad python module.
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+# LDraw meta command matching
+
+from collections import defaultdict
+
+from .constants import SPECIAL_TOKENS
+
+
+class MetaCommandMatcher:
+    """Matches lines of LDraw text against a dictionary of meta command
+    patterns such as SPECIAL_TOKENS.  Each pattern is a string of tokens
+    which must all be present in a line, and tokens of the form %n denote
+    the index of a value in the line to capture (%-1 is the last token).
+
+    The patterns are compiled once into a dispatch table keyed by the
+    least common literal token of each pattern, so that matching a line
+    only tests the few patterns which share a token with the line rather
+    than every pattern.  Patterns without any literal tokens are tested
+    against every line.  The matcher keeps its own copy of the pattern
+    dictionary, so registering a pattern does not change SPECIAL_TOKENS."""
+
+    def __init__(self, tokens=None):
+        tokens = tokens if tokens is not None else SPECIAL_TOKENS
+        self.tokens = {k: list(v) for k, v in tokens.items()}
+        self.compile()
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def compile(self):
+        """(Re)compiles the dispatch table from the pattern dictionary."""
+        self.patterns = []
+        for key, patterns in self.tokens.items():
+            for pattern in patterns:
+                tokens = pattern.split()
+                literals = frozenset([x for x in tokens if x[0] != "%"])
+                captures = tuple([int(x[1:]) for x in tokens if x[0] == "%"])
+                self.patterns.append((key, literals, captures))
+        freq = defaultdict(int)
+        for _, literals, _ in self.patterns:
+            for token in literals:
+                freq[token] += 1
+        self.dispatch = defaultdict(list)
+        self.catch_all = []
+        for i, (_, literals, _) in enumerate(self.patterns):
+            if not literals:
+                self.catch_all.append(i)
+                continue
+            token = min(sorted(literals), key=lambda x: freq[x])
+            self.dispatch[token].append(i)
+
+    def register(self, key, pattern):
+        """Adds a new meta command pattern identified by key.  Patterns
+        follow the same format as SPECIAL_TOKENS, e.g. "!PY MYCMD %3"."""
+        if key in self.tokens:
+            if pattern in self.tokens[key]:
+                return
+            self.tokens[key].append(pattern)
+        else:
+            self.tokens[key] = [pattern]
+        self.compile()
+
+    def match(self, line, ls=None):
+        """Returns a list of meta dictionaries for each pattern matched in line.
+        The matches are returned in the same order as the pattern dictionary.
+        The tokens of line can be provided in ls if it has already been split."""
+        ls = ls if ls is not None else line.split()
+        tokens = set(ls)
+        dispatch = self.dispatch
+        candidates = list(self.catch_all)
+        for token in tokens:
+            if token in dispatch:
+                candidates.extend(dispatch[token])
+        if not candidates:
+            return []
+        metas = []
+        linelen = len(ls)
+        for i in sorted(candidates):
+            key, literals, captures = self.patterns[i]
+            if not literals <= tokens:
+                continue
+            if len(captures) > 0:
+                values = [ls[x] for x in captures if x < linelen]
+                metas.append({key: {"values": values, "text": line}})
+            else:
+                metas.append({key: {"text": line}})
+        return metas
+
+
+META_MATCHER = MetaCommandMatcher()
+
+
+def register_special_token(key, pattern):
+    """Registers a custom meta command (e.g. a !PY or !LPUB command) which is
+    then recognized by parse_special_tokens and returned as a meta dictionary
+    identified by key."""
+    META_MATCHER.register(key, pattern)
@@ -24,12 +24,24 @@
 # LDraw model classes and helper functions
 
 import hashlib
+import sys
+from functools import partial
 
 import crayons
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from collections.abc import Sequence
+
+import numpy as np
 
 from toolbox import *
 from ldrawpy import *
+from .ldralias import PartAliases
+from .ldrcache import ParseCache, file_hash, CACHE_ERRORS
+from .ldrindex import LDRFileIndex, CalloutIndex, UnwrappedIndex, BOUNDARY_RE
+from .ldrmeta import META_MATCHER
+from .ldrparttable import PartTable, CumulativeParts
+from .ldrrotation import rotation_array
+from .ldrstep import LDRStep, LDRUnwrappedStep, StepPLI
 
 # import brickbom if available, otherwise don't raise since it is not
 # necessary for testing.
@@ -105,19 +117,32 @@ COMMON_SUBSTITUTIONS = [
     ("2776c28", "766bc03"),
     ("766c96", "766bc03"),
     ("7864-1", "u9058c02"),
-    ("bb0012vb","501bc01"),
-    ("bb0012v2","867"),
+    ("bb0012vb", "501bc01"),
+    ("bb0012v2", "867"),
     ("70026b", "70026"),
     ("3242c", "3240a"),
     ("4623b", "4623"),
     ("4623a", "4623"),
 ]
 
+# the compiled aliases of COMMON_SUBSTITUTIONS with the ignored and exception
+# parts used when parsing models.  User alias tables and the moved parts of an
+# LDraw library can be added with PART_ALIASES.load and .scan_library.  The
+# map tracks the lists, so changes made to them are applied (by refresh)
+# whenever a file is parsed.
+PART_ALIASES = PartAliases(
+    COMMON_SUBSTITUTIONS, ignore=IGNORE_LIST, exceptions=EXCEPTION_LIST
+)
+PART_ALIASES.track(COMMON_SUBSTITUTIONS, IGNORE_LIST, EXCEPTION_LIST)
+
+
+def substitute_name(name):
+    PART_ALIASES.refresh()
+    return PART_ALIASES.resolve(name)
+
 
 def substitute_part(part):
-    for e in COMMON_SUBSTITUTIONS:
-        if part.name == e[0]:
-            part.name = e[1]
+    part.name = substitute_name(part.name)
     return part
 
 
@@ -135,41 +160,15 @@ def line_has_all_tokens(line, tokenlist):
 
 
 def parse_special_tokens(line):
-    ls = line.split()
-    metas = []
-    for k, v in SPECIAL_TOKENS.items():
-        for t in v:
-            tokens = t.split()
-            tcount = 0
-            tlen = len([x for x in tokens if x[0] != "%"])
-            for token in tokens:
-                if token in ls:
-                    tcount += 1
-            if tcount == tlen:
-                linelen = len(ls)
-                captures = [int(x[1:]) for x in tokens if x[0] == "%"]
-                if len(captures) > 0:
-                    values = [ls[x] for x in captures if x < linelen]
-                    meta = {k: {"values": values, "text": line}}
-                else:
-                    meta = {k: {"text": line}}
-                metas.append(meta)
-    return metas
+    """Returns a list of meta dictionaries for each of the SPECIAL_TOKENS
+    (plus any registered with register_special_token) found in line."""
+    return META_MATCHER.match(line)
 
 
 def get_meta_commands(ldr_string):
     """Parses an LDraw string looking for known meta commands. Identified meta
     commands are returned in a dictionary."""
-    cmd = []
-    lines = ldr_string.splitlines()
-    for line in lines:
-        lineType = int(line.lstrip()[0] if line.lstrip() else -1)
-        if lineType == -1:
-            continue
-        if lineType == 0:
-            meta = parse_special_tokens(line)
-            if meta is not None:
-                cmd.extend(meta)
+    _, cmd = scan_ldraw(ldr_string)
     return cmd
 
 
@@ -177,56 +176,88 @@ def get_parts_from_model(ldr_string):
     """Extracts a list of parts representing LDraw parts (line type 1) from a
     string of LDraw text. The returned list is contains dictionary for each part
     with the keys "partname" and "ldrtext"."""
+    parts, _ = scan_ldraw(ldr_string, meta=False)
+    return parts
+
+
+def scan_ldraw(ldr_string, meta=True, matcher=None, aliases=None):
+    """Scans a string of LDraw text in a single pass and returns a list of the
+    parts (as described in get_parts_from_model) and a list of the meta commands
+    (as described in get_meta_commands) found in the text.  Each line is only
+    split into tokens once, and these tokens are used both to track the PLI and
+    BUFEXCHG masking state and to match any meta commands.  Meta commands are
+    matched with META_MATCHER unless another MetaCommandMatcher is provided,
+    and the exception parts which are kept in masked sections are those of
+    PART_ALIASES unless another PartAliases is provided."""
     parts = []
-    lines = ldr_string.splitlines()
+    cmd = []
+    start_tokens = [t.split() for t in START_TOKENS]
+    end_tokens = [t.split() for t in END_TOKENS]
+    store_tokens = ["BUFEXCHG", "STORE"]
+    retrieve_tokens = ["BUFEXCHG", "RETRIEVE"]
+    match = matcher.match if matcher is not None else META_MATCHER.match
+    aliases = aliases if aliases is not None else PART_ALIASES
+    exceptions = aliases.exceptions
     mask_depth = 0
     bufex = False
-    for line in lines:
-        pd = {}
-        if line_has_all_tokens(line, ["BUFEXCHG STORE"]):
+    for line in ldr_string.splitlines():
+        ls = line.split()
+        if not ls:
+            continue
+        if all(t in ls for t in store_tokens):
             bufex = True
-        if line_has_all_tokens(line, ["BUFEXCHG RETRIEVE"]):
+        if all(t in ls for t in retrieve_tokens):
             bufex = False
-        if line_has_all_tokens(line, START_TOKENS):
+        if any(all(t in ls for t in tokens) for tokens in start_tokens):
             mask_depth += 1
-        if line_has_all_tokens(line, END_TOKENS):
+        if any(all(t in ls for t in tokens) for tokens in end_tokens):
             if mask_depth > 0:
                 mask_depth -= 1
 
-        lineType = int(line.lstrip()[0] if line.lstrip() else -1)
-        if lineType == -1:
-            continue
-        if lineType == 1:
-            splitLine = line.lower().split()
-            pd["ldrtext"] = line
-            pd["partname"] = " ".join([str(i) for i in splitLine[14:]])
+        line_type = ls[0][0]
+        if line_type == "1":
+            partname = " ".join(ls[14:]).lower()
+            pd = {"ldrtext": line, "partname": partname}
             if mask_depth == 0:
                 parts.append(pd)
+            elif partname in exceptions:
+                parts.append(pd)
+            elif not bufex and partname.endswith(".ldr"):
+                parts.append(pd)
+        elif line_type == "0" and meta:
+            cmd.extend(match(line, ls))
+    return parts, cmd
+
+
+def get_proxy_parts(meta_cmd):
+    """Returns a list of LDRPart objects for the parts named by any PLI proxy
+    meta commands in a list of meta commands.  Proxy parts are named either
+    as a part name or as a part name and colour code joined by "_"."""
+    parts = []
+    for cmd in meta_cmd:
+        if "pli_proxy" not in cmd:
+            continue
+        for item in cmd["pli_proxy"]["values"]:
+            if "_" in item:
+                sp = item.split("_")
+                pname = sp[0]
+                pcolour = sp[1]
             else:
-                if pd["partname"] in EXCEPTION_LIST:
-                    parts.append(pd)
-                elif not bufex and pd["partname"].endswith(".ldr"):
-                    parts.append(pd)
+                pname = item
+                pcolour = LDR_DEF_COLOUR
+            parts.append(LDRPart(colour=pcolour, name=pname))
     return parts
 
 
-def recursive_parse_model(
-    model,
-    submodels,
-    parts,
-    offset=None,
-    matrix=None,
-    reset_parts=False,
-    only_submodel=None,
+def iter_recursive_parts(
+    model, submodels, offset=None, matrix=None, only_submodel=None
 ):
-    """Recursively parses an LDraw model dictionary plus any submodels and
-    populates a parts list representing that model.  To support selective
-    parsing of only one submodel, only_submodel can be set to the desired
-    submodel."""
+    """Generator which recursively traverses an LDraw model dictionary plus any
+    submodels and yields each part of the model transformed into the frame of
+    the model.  To support selective parsing of only one submodel, only_submodel
+    can be set to the desired submodel."""
     o = offset if offset is not None else Vector(0, 0, 0)
     m = matrix if matrix is not None else Identity()
-    if reset_parts:
-        parts.clear()
     for e in model:
         if only_submodel is not None:
             if not e["partname"] == only_submodel:
@@ -235,13 +266,12 @@ def recursive_parse_model(
             submodel = submodels[e["partname"]]
             p = LDRPart()
             p.from_str(e["ldrtext"])
-            new_matrix = m * p.attrib.matrix
-            new_loc = m * p.attrib.loc
+            new_matrix = m * p.attrib.peek_matrix()
+            new_loc = m * p.attrib.peek_loc()
             new_loc += o
-            recursive_parse_model(
+            yield from iter_recursive_parts(
                 submodel,
                 submodels,
-                parts,
                 offset=new_loc,
                 matrix=new_matrix,
             )
@@ -249,13 +279,504 @@ def recursive_parse_model(
             if only_submodel is None:
                 part = LDRPart()
                 part.from_str(e["ldrtext"])
-                part = substitute_part(part)
-                part.transform(matrix=m, offset=o)
-                if (
-                    not part.name in IGNORE_LIST
-                    and not part.name.upper() in IGNORE_LIST
-                ):
-                    parts.append(part)
+                name = PART_ALIASES.lookup(part.name)
+                if name is not None:
+                    part.name = name
+                    part.transform(matrix=m, offset=o)
+                    yield part
+
+
+class FlattenCache:
+    """A least recently used cache of submodels flattened into their own local
+    frame as PartTables.  The cache is limited to a budget of max_parts parts
+    in total (or unlimited if max_parts is None).  Each entry remembers the
+    parts lists of the submodels it was flattened from, and is invalidated if
+    any of them are replaced or changed in length, or if a different submodel
+    dictionary is used."""
+
+    def __init__(self, max_parts=None):
+        self.max_parts = max_parts
+        self.entries = OrderedDict()
+        self.submodels = None
+        self.parts = 0
+        self.hits = 0
+        self.misses = 0
+        self.aliases = {}
+        self.alias_submodels = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __str__(self):
+        return "FlattenCache: %d submodels, %d parts, %d hits, %d misses" % (
+            len(self.entries),
+            self.parts,
+            self.hits,
+            self.misses,
+        )
+
+    def clear(self):
+        self.entries.clear()
+        self.submodels = None
+        self.parts = 0
+
+    def set_aliases(self, aliases, submodels):
+        """Sets a dictionary of submodel names which are flattened as another
+        structurally identical submodel of the same submodel dictionary."""
+        self.aliases = aliases
+        self.alias_submodels = submodels
+
+    def alias(self, name, submodels):
+        """Returns the name of the submodel which is flattened for name."""
+        if submodels is self.alias_submodels:
+            return self.aliases.get(name, name)
+        return name
+
+    def _evict(self, name):
+        table, _ = self.entries.pop(name)
+        self.parts -= len(table)
+
+    def get(self, name, submodels):
+        """Returns a (table, dependencies) tuple for a cached submodel or None."""
+        if submodels is not self.submodels:
+            self.clear()
+            self.submodels = submodels
+        if name in self.entries:
+            table, deps = self.entries[name]
+            if all(submodels.get(n) is p and len(p) == lp for n, p, lp in deps):
+                self.entries.move_to_end(name)
+                self.hits += 1
+                return table, set([e[0] for e in deps])
+            self._evict(name)
+        self.misses += 1
+        return None
+
+    def put(self, name, table, deps, submodels):
+        if name in self.entries:
+            self._evict(name)
+        if self.max_parts is not None and len(table) > self.max_parts:
+            return
+        deps = tuple([(n, submodels[n], len(submodels[n])) for n in deps])
+        self.entries[name] = (table, deps)
+        self.parts += len(table)
+        while self.max_parts is not None and self.parts > self.max_parts:
+            self._evict(next(iter(self.entries)))
+
+
+def _flatten_submodel(name, submodels, cache, active, deps):
+    """Returns a PartTable of all the parts of a submodel in its own local
+    frame.  Each submodel is only flattened once and stored in the cache for
+    re-use by all of its instances, and structurally identical submodels
+    with an alias in the cache share the same flattened table."""
+    name = cache.alias(name, submodels)
+    entry = cache.get(name, submodels)
+    if entry is None:
+        if name in active:
+            raise ValueError("Submodel %s contains a reference to itself" % (name))
+        active.add(name)
+        sub_deps = set([name])
+        table = _flatten_parts(submodels[name], submodels, cache, active, sub_deps)
+        active.discard(name)
+        cache.put(name, table, sub_deps, submodels)
+    else:
+        table, sub_deps = entry
+    deps.update(sub_deps)
+    return table
+
+
+def _flatten_parts(model, submodels, cache, active, deps, only_submodel=None):
+    decoded = parse_part_lines([e["ldrtext"] for e in model])
+    lookup = PART_ALIASES.lookup
+    # the model is assembled in order from runs of leaf parts (stored as
+    # [start, end] indices into the leaf columns) and sub-model instances
+    pieces = []
+    names, colours, values = [], [], []
+    instances = defaultdict(list)
+    for e, d in zip(model, decoded):
+        if d is None:
+            continue
+        if only_submodel is not None:
+            if not e["partname"] == only_submodel:
+                continue
+        if e["partname"] in submodels:
+            instances[e["partname"]].append((len(pieces), d[1]))
+            pieces.append(None)
+        elif only_submodel is None:
+            name = lookup(d[2])
+            if name is None:
+                continue
+            if len(pieces) > 0 and isinstance(pieces[-1], list):
+                pieces[-1][1] += 1
+            else:
+                pieces.append([len(names), len(names) + 1])
+            names.append(name)
+            colours.append(d[0])
+            values.append(d[1])
+    leaf = PartTable(
+        names=names,
+        colours=colours,
+        loc=[v[0:3] for v in values],
+        matrix=[v[3:12] for v in values],
+    )
+    # all instances of a sub-model are placed with one batched transform
+    for name, refs in instances.items():
+        table = _flatten_submodel(name, submodels, cache, active, deps)
+        placed = table.instances(
+            [v[3:12] for _, v in refs],
+            [v[0:3] for _, v in refs],
+        )
+        for (idx, _), t in zip(refs, placed):
+            pieces[idx] = t
+    tables = [leaf[e[0] : e[1]] if isinstance(e, list) else e for e in pieces]
+    if len(tables) < 1:
+        return leaf
+    return PartTable.concat(tables)
+
+
+def flatten_model(
+    model, submodels, offset=None, matrix=None, only_submodel=None, cache=None
+):
+    """Flattens an LDraw model dictionary plus any submodels into a PartTable of
+    all of its parts.  Rather than traversing every instance of every submodel,
+    each submodel is flattened once into its own local frame and its instances
+    are placed with batched matrix multiplications.  The parts are returned in
+    the same order and with the same part substitutions and ignored parts as
+    recursive_parse_model, transformed by an optional matrix and offset.
+    The flattened submodels can be kept between calls in a FlattenCache."""
+    cache = cache if cache is not None else FlattenCache()
+    table = _flatten_parts(
+        model, submodels, cache, set(), set(), only_submodel=only_submodel
+    )
+    if matrix is not None or offset is not None:
+        table = table.transform(matrix=matrix, offset=offset)
+    return table
+
+
+class SubmodelGraph:
+    """Dependency graph of the submodels of a model.  Each submodel is a node
+    with edges to the submodels it contains, weighted by the number of
+    instances.  The quantity of each part (keyed by (name, colour) tuples)
+    in each distinct submodel is computed once in topological order and the
+    quantities of a model are then found by multiplying the submodel counts
+    by their instance counts rather than by expanding every instance."""
+
+    def __init__(self, submodels):
+        self.submodels = submodels
+        self.children = {}
+        self.leaf_counts = {}
+        for name, model in submodels.items():
+            self.children[name], self.leaf_counts[name] = self._scan(model)
+        self.order = self.topological_order()
+        self._hashes = None
+        self._layout_hashes = None
+        self.counts = {}
+        for name in self.order:
+            self.counts[name] = self._total(self.children[name], self.leaf_counts[name])
+
+    def __len__(self):
+        return len(self.submodels)
+
+    def __str__(self):
+        return "SubmodelGraph: %d submodels, %d edges" % (
+            len(self),
+            sum([len(v) for v in self.children.values()]),
+        )
+
+    def _scan(self, model):
+        """Returns the submodel instance counts and leaf part counts of the
+        part dictionaries of a model (as returned by get_parts_from_model)."""
+        children = defaultdict(int)
+        leaves = defaultdict(int)
+        decoded = parse_part_lines([e["ldrtext"] for e in model])
+        for e, d in zip(model, decoded):
+            if d is None:
+                continue
+            if e["partname"] in self.submodels:
+                children[e["partname"]] += 1
+                continue
+            name = PART_ALIASES.lookup(d[2])
+            if name is None:
+                continue
+            leaves[(name, d[0])] += 1
+        return dict(children), dict(leaves)
+
+    def _total(self, children, leaves):
+        counts = defaultdict(int, leaves)
+        for child, qty in children.items():
+            for key, n in self.counts[child].items():
+                counts[key] += qty * n
+        return dict(counts)
+
+    def topological_order(self):
+        """Returns the submodel names ordered so that every submodel comes
+        after all of the submodels it contains.  A ValueError is raised if
+        the submodels contain a cycle of references."""
+        pending = {name: len(v) for name, v in self.children.items()}
+        parents = defaultdict(list)
+        for name, children in self.children.items():
+            for child in children:
+                parents[child].append(name)
+        ready = [name for name, n in pending.items() if n == 0]
+        order = []
+        while ready:
+            name = ready.pop()
+            order.append(name)
+            for parent in parents[name]:
+                pending[parent] -= 1
+                if pending[parent] == 0:
+                    ready.append(parent)
+        if len(order) < len(pending):
+            cycle = sorted([name for name, n in pending.items() if n > 0])
+            raise ValueError(
+                "Submodels contain a cycle of references: %s" % (", ".join(cycle))
+            )
+        return order
+
+    @property
+    def hashes(self):
+        """Returns a dictionary of the structural hash of each submodel built
+        from its sorted quantized part records and the hashes of its child
+        submodels.  Submodels with the same hash are geometrically identical
+        even if their names or the order of their parts are different."""
+        if self._hashes is None:
+            self._hashes = self._compute_hashes(ordered=False)
+        return self._hashes
+
+    @property
+    def layout_hashes(self):
+        """Returns a dictionary of the hash of each submodel built from its
+        quantized part records in file order and the layout hashes of its
+        child submodels.  Submodels with the same layout hash flatten into
+        identical part tables."""
+        if self._layout_hashes is None:
+            self._layout_hashes = self._compute_hashes(ordered=True)
+        return self._layout_hashes
+
+    def _compute_hashes(self, ordered):
+        hashes = {}
+        for name in self.order:
+            hashes[name] = get_sha1_hash(
+                self.submodels[name], submodel_hashes=hashes, ordered=ordered
+            )
+        return hashes
+
+    def aliases(self):
+        """Returns a dictionary of each submodel name which is a duplicate of
+        another submodel, i.e. with the same parts in the same order, mapped
+        to the name of the first (in file order) identical submodel."""
+        first = {}
+        aliases = {}
+        for name in self.submodels:
+            h = self.layout_hashes[name]
+            if h in first:
+                aliases[name] = first[h]
+            else:
+                first[h] = name
+        return aliases
+
+    def model_counts(self, model):
+        """Returns the quantity of each part keyed by (name, colour) in a model
+        provided as a list of part dictionaries."""
+        children, leaves = self._scan(model)
+        return self._total(children, leaves)
+
+
+def recursive_parse_model(
+    model,
+    submodels,
+    parts,
+    offset=None,
+    matrix=None,
+    reset_parts=False,
+    only_submodel=None,
+    cache=None,
+):
+    """Recursively parses an LDraw model dictionary plus any submodels and
+    populates a parts list representing that model.  To support selective
+    parsing of only one submodel, only_submodel can be set to the desired
+    submodel.  An optional FlattenCache re-uses previously flattened
+    submodels."""
+    if reset_parts:
+        parts.clear()
+    table = flatten_model(
+        model,
+        submodels,
+        offset=offset,
+        matrix=matrix,
+        only_submodel=only_submodel,
+        cache=cache,
+    )
+    parts.extend(table.to_parts())
+
+
+def scan_model_parts(source):
+    """Scans the LDraw text of a filename, a file object or stdin (if source
+    is None or "-") and returns a tuple of:
+        steps - a list of the (parts, proxy parts) of each step of the root
+            model which is kept by parse_model, i.e. which has parts or PLI
+            proxy parts.  The parts are part dictionaries as returned by
+            get_parts_from_model and the proxy parts are LDRPart objects
+        graph - the SubmodelGraph of the submodels
+        proxy_counts - the quantity of each proxy part keyed by (name, colour)
+    Proxy parts are counted in the same way as the LDRModel BOM, i.e. the
+    proxy parts of each step of the root model are counted when the step is
+    parsed and, as for every step (of any submodel) which declares proxy
+    parts, again for each time the step is unwrapped.  A submodel's steps
+    are unwrapped once for each step which refers to the submodel
+    (regardless of the number of instances in that step)."""
+    PART_ALIASES.refresh()
+    index = LDRFileIndex("".join(_iter_ldraw_lines(source)))
+    submodels = {}
+    for name in index.names[1:]:
+        submodels[name] = get_parts_from_model(index.file_text(name))
+    graph = SubmodelGraph(submodels)
+    model_steps = {}
+    unwrapped_proxies = {}
+
+    def steps_of(name):
+        # the (parts, unique submodels, proxy parts) of each step of a model
+        # which is kept by parse_model
+        if name not in model_steps:
+            steps = []
+            for step in index.step_texts(name):
+                parts, meta_cmd = scan_ldraw(step)
+                proxies = get_proxy_parts(meta_cmd)
+                if sum(graph.model_counts(parts).values()) + len(proxies) > 0:
+                    subs = unique_set(
+                        [p["partname"] for p in parts if p["partname"] in submodels]
+                    )
+                    steps.append((parts, list(subs), proxies))
+            model_steps[name] = steps
+        return model_steps[name]
+
+    def proxies_of(name):
+        # the proxy parts added to the BOM when a model is unwrapped
+        if name not in unwrapped_proxies:
+            counts = defaultdict(int)
+            for _, subs, proxies in steps_of(name):
+                for sub in subs:
+                    for key, qty in proxies_of(sub).items():
+                        counts[key] += qty
+                for p in proxies:
+                    counts[(p.name, p.attrib.colour)] += 1
+            unwrapped_proxies[name] = dict(counts)
+        return unwrapped_proxies[name]
+
+    steps = [(parts, proxies) for parts, _, proxies in steps_of(index.root)]
+    proxy_counts = defaultdict(int, proxies_of(index.root))
+    for _, proxies in steps:
+        for p in proxies:
+            proxy_counts[(p.name, p.attrib.colour)] += 1
+    return steps, graph, dict(proxy_counts)
+
+
+def file_part_counts(filename):
+    """Returns the quantity of each part keyed by (name, colour) used in the
+    root model of an LDraw file.  The counts are the same as the BOM of the
+    model parsed with LDRModel, including PLI proxy parts (as described in
+    scan_model_parts), but are found by scanning the file and multiplying
+    up the part counts of its submodel graph without parsing the model steps
+    or expanding any submodel instances."""
+    steps, graph, proxy_counts = scan_model_parts(filename)
+    counts = defaultdict(int, proxy_counts)
+    for parts, _ in steps:
+        for key, qty in graph.model_counts(parts).items():
+            counts[key] += qty
+    return dict(counts)
+
+
+def _iter_ldraw_lines(source):
+    if source is None or source == "-":
+        yield from sys.stdin
+    elif isinstance(source, str):
+        with open(source, "rt") as fp:
+            yield from fp
+    else:
+        yield from source
+
+
+def read_model_parts(source, meta=False):
+    """Reads LDraw text line by line from a filename, a file object or stdin
+    (if source is None or "-") and returns the parts referenced in each step
+    of the root model and a dictionary of the parts in each submodel.  The
+    parts are represented with the same dictionaries returned by
+    get_parts_from_model.  If meta is True, each root step is returned as a
+    (parts, meta commands) tuple as returned by scan_ldraw.
+
+    The LDraw text is never held in memory as a whole, only the lines of the
+    file currently being read are buffered.  However, since the submodels of
+    a MPD file follow the root model which refers to them, the part
+    dictionaries of every file are kept until the whole source is read, i.e.
+    memory use is proportional to the number of part lines in the source
+    (but not to the number of parts after the submodels are expanded)."""
+    PART_ALIASES.refresh()
+    root_steps = None
+    submodels = {}
+    name, steps, lines = "", [], []
+    has_files = False
+
+    def close_file():
+        nonlocal root_steps
+        if root_steps is None:
+            texts = ["".join(e) for e in steps + [lines]]
+            if meta:
+                root_steps = [scan_ldraw(text) for text in texts]
+            else:
+                root_steps = [get_parts_from_model(text) for text in texts]
+        else:
+            text = "".join(["".join(e) for e in steps + [lines]])
+            submodels[name] = get_parts_from_model(text)
+
+    for line in _iter_ldraw_lines(source):
+        m = BOUNDARY_RE.match(line)
+        if m is not None and m.group("kind") == "STEP":
+            steps.append(lines)
+            lines = []
+            continue
+        if m is not None and m.group("kind") == "FILE":
+            # any text preceding the first FILE of a MPD file is discarded
+            if has_files:
+                close_file()
+            has_files = True
+            name = line[m.end() :].lower().strip()
+            steps, lines = [], []
+        lines.append(line)
+    close_file()
+    return root_steps, submodels
+
+
+def iter_flattened_parts(source, with_steps=False):
+    """Generator which yields every part of an LDraw model step by step,
+    transformed into the frame of the root model.  The source can either be
+    a filename, a file object or stdin (if source is None or "-").  Parts
+    are yielded with the same submodel expansion, part substitutions and
+    ignored parts as recursive_parse_model, however, the model steps are
+    never accumulated and the expanded parts are never held in memory.
+    This allows very large models to be flattened (e.g. for a BOM) in a
+    pipeline with memory use bounded by the size of the source (see
+    read_model_parts) rather than by the number of expanded parts.
+    If with_steps is True, then (step number, part) tuples are yielded
+    with the same step numbering as parse_model, i.e. steps without any
+    parts which only add PLI proxy parts are also numbered."""
+    root_steps, submodels = read_model_parts(source, meta=True)
+    step_num = 1
+    for step_parts, meta_cmd in root_steps:
+        count = 0
+        for part in iter_recursive_parts(step_parts, submodels):
+            count += 1
+            yield (step_num, part) if with_steps else part
+        if count > 0 or len(get_proxy_parts(meta_cmd)) > 0:
+            step_num += 1
+
+
+def _is_sequence(v):
+    """Returns True if a step value is a sequence of items (e.g. a list of
+    parts or a CumulativePartsView) rather than a single value.  Strings
+    and tuples such as aspect angles are single values."""
+    return isinstance(v, Sequence) and not isinstance(v, (str, tuple))
 
 
 def unique_set(items):
@@ -279,13 +800,44 @@ def key_colour(elem):
     return elem.attrib.colour
 
 
-def get_sha1_hash(parts):
-    """Gets a normalized sha1 hash LDRPart objects"""
-    sp = [(p, p.sha1hash()) for p in parts]
-    sp.sort(key=lambda x: x[1])
+def part_record(part, submodel_hashes=None):
+    """Returns a canonical string for a part dictionary (as returned by
+    get_parts_from_model) with its location and matrix values quantized.
+    References to submodels with a hash in submodel_hashes are named by
+    their hash and other part names are substituted as when flattened.
+    None is returned for invalid lines and ignored parts."""
+    d = parse_part_line(part["ldrtext"])
+    if d is None:
+        return None
+    if submodel_hashes is not None and part["partname"] in submodel_hashes:
+        name = "@" + submodel_hashes[part["partname"]]
+    else:
+        name = PART_ALIASES.lookup(d[2])
+        if name is None:
+            return None
+    return "1 %d %s%s" % (d[0], mat_str(d[1]), name)
+
+
+def get_sha1_hash(parts, submodel_hashes=None, ordered=False):
+    """Gets a normalized sha1 hash of a list of parts, either LDRPart objects
+    or part dictionaries as returned by get_parts_from_model.  The hash does
+    not depend on the order of the parts unless ordered is True.  Submodels
+    referred to by part dictionaries are hashed by their structural hash in
+    submodel_hashes rather than by name, so that the hash of a model only
+    depends on its geometry and not on the names of its submodels."""
+    hashes = []
+    for p in parts:
+        if isinstance(p, LDRPart):
+            hashes.append(p.sha1hash())
+            continue
+        record = part_record(p, submodel_hashes)
+        if record is not None:
+            hashes.append(hashlib.sha1(bytes(record, encoding="utf8")).hexdigest())
+    if not ordered:
+        hashes.sort()
     shash = hashlib.sha1()
-    for p in sp:
-        shash.update(bytes(p[1], encoding="utf8"))
+    for h in hashes:
+        shash.update(bytes(h, encoding="utf8"))
     return shash.hexdigest()
 
 
@@ -318,6 +870,11 @@ class LDRModel:
         },
         "callout_step_thr": 6,
         "continuous_step_numbers": False,
+        "flatten_cache_parts": 1000000,
+        "lazy": False,
+        "cache_dir": None,
+        "cache_max_bytes": 1 << 30,
+        "dedup_submodels": False,
     }
 
     def __init__(self, filename, **kwargs):
@@ -332,8 +889,15 @@ class LDRModel:
         self.sub_models = {}
         self.sub_model_str = {}
         self.unwrapped = None
+        self.unwrapped_index = UnwrappedIndex()
         self.callouts = {}
+        self.callout_index = CalloutIndex()
         self.continuous_step_count = 0
+        self.index = None
+        self.flatten_cache = FlattenCache(self.flatten_cache_parts)
+        self.sub_model_steps = {}
+        self.proxy_boms = {}
+        self.graph = None
 
     def __str__(self):
         s = []
@@ -358,7 +922,7 @@ class LDRModel:
                         print("%s: " % (ks))
                         for e in vs:
                             print("  %s" % (str(e).rstrip()))
-                elif isinstance(v, list):
+                elif _is_sequence(v):
                     print("%s: " % (k))
                     for vx in v:
                         print("  %s" % (str(vx).rstrip()))
@@ -368,7 +932,7 @@ class LDRModel:
     def print_unwrapped_dict(self, idx):
         s = self.unwrapped[idx]
         for k, v in s.items():
-            if isinstance(v, list):
+            if _is_sequence(v):
                 print("%s: " % (k))
                 for vx in v:
                     print("  %s" % (str(vx).rstrip()))
@@ -487,25 +1051,15 @@ class LDRModel:
             return len(self.unwrapped) + step
         if step < 1:
             return 0
+        index = self.unwrapped_index
         if as_start_idx:
-            if self.continuous_step_numbers:
-                for s in self.unwrapped:
-                    if s["step"] == step - 1 and s["callout"] == 0:
-                        return s["idx"] + 1
-            else:
-                for s in self.unwrapped:
-                    if s["step"] == step - 1 and s["level"] == 0:
-                        return s["idx"] + 1
+            idx = index.step_idx(step - 1, self.continuous_step_numbers)
+            if idx is not None:
+                return idx + 1
         else:
-            if self.continuous_step_numbers:
-                for s in self.unwrapped:
-                    if s["step"] == step and s["callout"] == 0:
-                        return s["idx"]
-            else:
-                for s in self.unwrapped:
-                    if s["step"] == step and s["level"] == 0:
-                        return s["idx"]
-
+            idx = index.step_idx(step, self.continuous_step_numbers)
+            if idx is not None:
+                return idx
         return len(self.unwrapped) - 1
 
     def print_callouts(self):
@@ -533,47 +1087,30 @@ class LDRModel:
     def is_callout_end(self, idx):
         """Returns True if the index to the unwrapped model points to a
         step at the end of a callout sequence."""
-        for k, v in self.callouts.items():
-            if v["end"] == idx:
-                return True
-        return False
+        return self.callout_index.is_end(idx)
 
     def callout_has_meta(self, idx, tag):
         """Returns True if the index to the unwrapped model points to a
         a callout whose model has a specified meta tag."""
-        for k, v in self.callouts.items():
-            if idx >= k and idx <= v["end"]:
-                for i in range(k, v["end"] + 1):
-                    if self.step_has_meta(i, tag):
-                        return True
-        return False
+        return self.callout_index.has_meta(idx, tag)
 
     def callout_meta_values(self, idx, tag):
         """Returns the values of a callout whose model has a specified meta tag."""
-        for k, v in self.callouts.items():
-            if idx >= k and idx <= v["end"]:
-                for i in range(k, v["end"] + 1):
-                    if self.step_has_meta(i, tag):
-                        return self.step_meta_values(idx, tag)
+        if self.callout_index.has_meta(idx, tag):
+            return self.step_meta_values(idx, tag)
         return None
 
     def callout_parent(self, idx):
         """Returns the level into the model hierarchy of a callout's
         parent level at the specified index into the unwrapped model."""
-        level = 0
-        for k, v in self.callouts.items():
-            if idx >= k and idx <= v["end"]:
-                level = max(level, v["parent"])
-        return level
+        return self.callout_index.parent(idx)
 
     def is_parent_a_callout(self, idx):
         """Returns True if at the index into the unwrapped model
         a callout step is contained in another callout."""
-        my_parent = self.callout_parent(idx)
+        my_parent = self.callout_index.parent(idx)
         if my_parent > 0:
-            for k, v in self.callouts.items():
-                if v["level"] == my_parent and idx >= k and idx <= v["end"]:
-                    return True
+            return self.callout_index.in_level(idx, my_parent)
         return False
 
     def has_assembly_arrows(self, idx):
@@ -590,26 +1127,16 @@ class LDRModel:
         return False
 
     def step_meta_values(self, idx, tag):
-        meta = self.unwrapped[idx]["meta"]
-        for m in meta:
-            if tag in m:
-                return m[tag]["values"]
+        m = self.unwrapped_index.meta(idx, tag)
+        if m is not None:
+            return m[tag]["values"]
         return None
 
     def count_meta_keys(self, idx, tag):
-        meta = self.unwrapped[idx]["meta"]
-        count = 0
-        for m in meta:
-            if tag in m:
-                count += 1
-        return count
+        return self.unwrapped_index.meta_count(idx, tag)
 
     def step_has_meta(self, idx, tag):
-        meta = self.unwrapped[idx]["meta"]
-        for m in meta:
-            if tag in m:
-                return True
-        return False
+        return self.unwrapped_index.has_meta(idx, tag)
 
     def has_no_preview_meta(self, idx):
         return self.step_has_meta(idx, "no_preview")
@@ -640,31 +1167,56 @@ class LDRModel:
     def get_sub_model_assem(self, submodel):
         """Returns the index into the unwrapped model of a specified
         sub-model assembly."""
-        last_idx = 0
         submodel = submodel if ".ldr" in submodel else submodel + ".ldr"
-        for s in self.unwrapped:
-            if s["model"] == submodel:
-                last_idx = max(last_idx, s["idx"])
-        return last_idx
+        return self.unwrapped_index.model_last_idx(submodel)
 
     def model_has_meta(self, submodel, tag):
         submodel = submodel if ".ldr" in submodel else submodel + ".ldr"
-        for s in self.unwrapped:
-            if s["model"] == submodel:
-                if self.step_has_meta(s["idx"], tag):
-                    return True
-        return False
+        return self.unwrapped_index.model_meta_idx(submodel, tag) is not None
 
     def model_meta_values(self, submodel, tag):
         submodel = submodel if ".ldr" in submodel else submodel + ".ldr"
-        for s in self.unwrapped:
-            if s["model"] == submodel:
-                if self.step_has_meta(s["idx"], tag):
-                    return self.step_meta_values(s["idx"], tag)
+        idx = self.unwrapped_index.model_meta_idx(submodel, tag)
+        if idx is not None:
+            return self.step_meta_values(idx, tag)
         return None
 
+    def parse_context(self):
+        """Returns a tuple of the parameters which affect the parsing of a
+        submodel into steps."""
+        return (
+            tuple(self.global_aspect),
+            self.global_scale,
+            tuple(self.pli_aspect),
+            tuple(sorted(self.pli_exceptions.items())),
+        )
+
+    def sub_model_hash(self, name):
+        """Returns the structural hash of a submodel.  Submodels with the same
+        hash are geometrically identical and can share a rendered image."""
+        return self.submodel_graph().hashes[name]
+
+    def parse_sub_model(self, name):
+        """Returns the PLI and steps of a submodel as returned by parse_model.
+        Each submodel is only parsed once for the same parsing parameters and
+        the result is shared wherever the submodel is used."""
+        key = (name, self.parse_context())
+        if key not in self.sub_model_steps:
+            self.sub_model_steps[key] = self.parse_model(name, is_top_level=False)
+        return self.sub_model_steps[key]
+
+    def iter_unwrapped(self, start=0, stop=None):
+        """Generator which yields each step of the unwrapped model in sequence
+        from index start up to (but not including) index stop."""
+        if self.unwrapped is None:
+            return
+        stop = len(self.unwrapped) if stop is None else stop
+        for idx in range(start, min(stop, len(self.unwrapped))):
+            yield self.unwrapped[idx]
+
     def unwrap(self):
         self.unwrapped = self.unwrap_model()
+        self.unwrapped_index = UnwrappedIndex(self.unwrapped)
 
     def unwrap_model(
         self,
@@ -704,7 +1256,7 @@ class LDRModel:
             if len(v["sub_models"]) > 0:
                 subs = unique_set(v["sub_models"])
                 for name, qty in subs.items():
-                    pli, steps = self.parse_model(name, is_top_level=False)
+                    pli, steps = self.parse_sub_model(name)
                     _, newidx = self.unwrap_model(
                         root=steps,
                         idx=idx,
@@ -714,25 +1266,16 @@ class LDRModel:
                         unwrapped=unwrapped,
                     )
                     idx = newidx
-            sd = {
-                "idx": idx,
-                "level": level,
-                "step": k,
-                "next_step": k + 1 if k < len(model.items()) else k,
-                "num_steps": len(model.items()),
-                "model": model_name,
-                "qty": model_qty,
-                "scale": v["scale"],
-                "model_scale": v["model_scale"],
-                "aspect": v["aspect"],
-                "parts": v["parts"],
-                "step_parts": v["step_parts"],
-                "pli_bom": v["pli_bom"],
-                "meta": v["meta"],
-                "aspect_change": v["aspect_change"],
-                "raw_ldraw": v["raw_ldraw"],
-                "sub_parts": v["sub_parts"],
-            }
+            sd = LDRUnwrappedStep(
+                v,
+                idx=idx,
+                level=level,
+                step=k,
+                next_step=k + 1 if k < len(model.items()) else k,
+                num_steps=len(model.items()),
+                model=model_name,
+                qty=model_qty,
+            )
             unwrapped.append(sd)
             idx += 1
         if level == 0:
@@ -745,10 +1288,10 @@ class LDRModel:
             prev_level = 0
             next_level = 0
             prev_break = False
+            # stack of open callouts as (start idx, level, parent level) which
+            # are paired with their end idx as the levels unwind
             callout = []
-            callout_start = []
-            callout_end = []
-            callout_parent = []
+            callout_pairs = []
             dont_callout_models = []
             for i, e in enumerate(unwrapped):
                 level = e["level"]
@@ -792,10 +1335,16 @@ class LDRModel:
                     else page_break
                 )
                 pb = False
+                # steps of a submodel are shared by all of its instances so
+                # proxy parts are only added once to the step's PLI BOM
+                add_proxies = None
                 for x in unwrapped[i]["meta"]:
                     if "page_break" in x:
                         pb = True
                     elif "pli_proxy" in x:
+                        if add_proxies is None:
+                            add_proxies = not id(e["pli_bom"]) in self.proxy_boms
+                        self.proxy_boms[id(e["pli_bom"])] = e["pli_bom"]
                         for item in x["pli_proxy"]["values"]:
                             if "_" in item:
                                 sp = item.split("_")
@@ -805,7 +1354,8 @@ class LDRModel:
                                 pname = item
                                 pcolour = LDR_DEF_COLOUR
                             proxy_part = BOMPart(1, pname, pcolour)
-                            e["pli_bom"].add_part(proxy_part)
+                            if add_proxies:
+                                e["pli_bom"].add_part(proxy_part)
                             self.bom.add_part(proxy_part)
 
                 page_break = True if pb else page_break
@@ -815,16 +1365,14 @@ class LDRModel:
                     and (e["num_steps"] < self.callout_step_thr)
                     and not dont_callout
                 ):
-                    callout.append(level)
-                    callout_start.append(i)
-                    callout_parent.append(prev_level)
+                    callout.append((i, level, prev_level))
 
                 elif levelled_down:
                     if len(callout) > 0:
-                        callout.pop()
-                        callout_end.append(i - 1)
+                        x0, callout_level, parent = callout.pop()
+                        callout_pairs.append((x0, i - 1, callout_level, parent))
                 if len(callout) > 0:
-                    callout_level = callout[len(callout) - 1]
+                    callout_level = callout[-1][1]
                 else:
                     callout_level = 0
                 if self.continuous_step_numbers:
@@ -832,130 +1380,295 @@ class LDRModel:
                         e["step"] = step_num
                         step_num += 1
                         self.continuous_step_count += 1
-                x = {
-                    **e,
-                    "prev_level": prev_level,
-                    "next_level": next_level,
-                    "page_break": page_break,
-                    "no_pli": no_pli,
-                    "callout": callout_level,
-                }
-                umodel.append(x)
+                # the unwrapped step is updated in place rather than copied
+                e.prev_level = prev_level
+                e.next_level = next_level
+                e.page_break = page_break
+                e.no_pli = no_pli
+                e.callout = callout_level
+                umodel.append(e)
                 prev_level = level
                 prev_break = page_break
             if self.continuous_step_numbers:
                 for e in umodel:
                     if e["callout"] == 0:
                         e["num_steps"] = self.continuous_step_count
-            # pair up the callout boundaries in dictionary with the start
+            # store the callout boundaries in dictionary with the start
             # index as the key and the end index and parent level as values
             self.callouts = {}
-            for x0, p in zip(callout_start, callout_parent):
-                level = umodel[x0]["callout"]
-                for x1 in callout_end:
-                    endlevel = umodel[x1]["callout"]
-                    if x1 >= x0 and level == endlevel:
-                        self.callouts[x0] = {"level": level, "end": x1, "parent": p}
-                        # set custom scale for the callout if configured
-                        if self.has_meta_tag(umodel[x0]["meta"], "model_scale"):
-                            self.callouts[x0]["scale"] = umodel[x0]["model_scale"]
-                            for ix in range(x0, x1 + 1):
-                                umodel[ix]["scale"] = umodel[ix]["model_scale"]
-                        break
+            for x0, x1, level, p in sorted(callout_pairs):
+                self.callouts[x0] = {"level": level, "end": x1, "parent": p}
+                # set custom scale for the callout if configured
+                if self.has_meta_tag(umodel[x0]["meta"], "model_scale"):
+                    self.callouts[x0]["scale"] = umodel[x0]["model_scale"]
+                    for ix in range(x0, x1 + 1):
+                        umodel[ix]["scale"] = umodel[ix]["model_scale"]
+            self.callout_index = CalloutIndex(self.callouts, umodel)
 
             return umodel
         return unwrapped, idx
 
-    def transform_parts_to(self, parts, origin=None, aspect=None, use_exceptions=False):
-        """Transforms the location and/or aspect angle of all the parts in
-        a list to a fixed position and/or aspect angle."""
+    def transform_table_to(self, table, origin=None, aspect=None, use_exceptions=False):
+        """Returns a new PartTable with all of its parts set to a fixed aspect
+        angle and optionally moved to a fixed origin.  The rotation matrix for
+        each distinct aspect is only computed once for the whole table."""
         aspect = aspect if aspect is not None else self.global_aspect
-        if origin is not None and not isinstance(origin, Vector):
-            origin = Vector(origin[0], origin[1], origin[2])
-        tparts = []
-        for p in parts:
-            np = p.copy()
-            angle = aspect
+        rm = rotation_array(aspect)
+        if use_exceptions and any(
+            [name in self.pli_exceptions for name in table.categories]
+        ):
             # override the aspect angle for any parts which need a special
             # orientation for clarity
-            if use_exceptions:
-                if p.name in self.pli_exceptions:
-                    angle = self.pli_exceptions[p.name]
-            np.set_rotation(angle)
-            if origin is not None:
-                np.move_to(origin)
-            tparts.append(np)
-        return tparts
+            mats = np.empty((len(table.categories), 3, 3), dtype=np.float64)
+            for i, name in enumerate(table.categories):
+                if name in self.pli_exceptions:
+                    mats[i] = rotation_array(self.pli_exceptions[name])
+                else:
+                    mats[i] = rm
+            table = table.set_rotation(mats[table.codes])
+        else:
+            table = table.set_rotation(rm)
+        if origin is not None:
+            table = table.move_to(origin)
+        return table
+
+    def transform_table(self, table, offset=None, aspect=None):
+        """Returns a new PartTable with all of its parts rotated by an aspect
+        angle and then moved by an optional offset with one batched matrix
+        multiplication."""
+        aspect = aspect if aspect is not None else self.global_aspect
+        return table.transform(matrix=rotation_array(aspect), offset=offset)
+
+    def _apply_to_parts(self, parts, kernel, keep_invalid=False):
+        """Applies a PartTable kernel to a list of LDRPart objects or LDraw
+        text lines and returns a list of the same type of items."""
+        if isinstance(parts[0], LDRPart):
+            tparts = kernel(PartTable.from_parts(parts)).to_parts()
+            for p, tp in zip(parts, tparts):
+                tp.wrapcallout = p.wrapcallout
+                tp.attrib.units = p.attrib.units
+            return tparts
+        decoded = parse_part_lines(parts)
+        valid = [d for d in decoded if d is not None]
+        table = PartTable(
+            names=[d[2] for d in valid],
+            colours=[d[0] for d in valid],
+            loc=[d[1][0:3] for d in valid],
+            matrix=[d[1][3:12] for d in valid],
+        )
+        tparts = iter(kernel(table).to_parts())
+        if not keep_invalid:
+            return list(tparts)
+        return [
+            str(next(tparts)) if d is not None else p for p, d in zip(parts, decoded)
+        ]
+
+    def transform_parts_to(self, parts, origin=None, aspect=None, use_exceptions=False):
+        """Transforms the location and/or aspect angle of all the parts in
+        a list to a fixed position and/or aspect angle."""
+        if len(parts) < 1:
+            return []
+        return self._apply_to_parts(
+            parts,
+            lambda t: self.transform_table_to(t, origin, aspect, use_exceptions),
+        )
 
     def transform_parts(self, parts, offset=None, aspect=None):
         """Transforms the geometry (location and or aspect angle) of all
         the parts in a list.  The transform is applied as an offset to
         the existing part geometry."""
-        aspect = aspect if aspect is not None else self.global_aspect
-        if offset is not None and not isinstance(offset, Vector):
-            offset = Vector(offset[0], offset[1], offset[2])
-        tparts = []
         if len(parts) < 1:
             return []
-        if isinstance(parts[0], LDRPart):
-            for p in parts:
-                np = p.copy()
-                np.rotate_by(aspect)
-                if offset is not None:
-                    np.move_by(offset)
-                tparts.append(np)
-            return tparts
-        else:
-            for p in parts:
-                np = LDRPart()
-                if np.from_str(p) is not None:
-                    np.rotate_by(aspect)
-                    if offset is not None:
-                        np.move_by(offset)
-                    tparts.append(str(np))
-                else:
-                    # print("part is None ", p)
-                    tparts.append(p)
-            return tparts
+        return self._apply_to_parts(
+            parts,
+            lambda t: self.transform_table(t, offset, aspect),
+            keep_invalid=True,
+        )
 
     def transform_colour(self, parts, to_colour, from_colour=None, as_str=False):
         """Transforms the colour of a provided list of parts."""
-        tparts = []
         if len(parts) < 1:
             return
-        if isinstance(parts[0], LDRPart):
-            for p in parts:
-                np = p.copy()
-                np.change_colour(to_colour)
-                tparts.append(np)
+        if isinstance(to_colour, (int, np.integer)):
+            tparts = self._apply_to_parts(parts, lambda t: t.change_colour(to_colour))
         else:
+            tparts = []
             for p in parts:
-                np = LDRPart()
-                if np.from_str(p) is not None:
-                    np.change_colour(to_colour)
-                    tparts.append(np)
+                tp = LDRPart()
+                if isinstance(p, LDRPart):
+                    tp = p.copy()
+                elif tp.from_str(p) is None:
+                    continue
+                tp.change_colour(to_colour)
+                tparts.append(tp)
         if as_str:
             return [str(p) for p in tparts]
         return tparts
 
-    def parse_file(self):
+    def parse_file(self, use_cache=True):
         """Parses an LDraw file and determines the root model and any included
-        submodels."""
+        submodels.  If a cache directory is configured with the cache_dir
+        parameter, the parsed results are loaded from the cache if the same
+        file has already been parsed with the same parameters, otherwise the
+        results are parsed and then stored in the cache.  Steps loaded from
+        the cache are lazily loaded steps (see cached_results)."""
         self.sub_models = {}
-        with open(self.filename, "rt") as fp:
-            files = fp.read().split("0 FILE")
-            root = None
-            if len(files) == 1:
-                root = files[0]
-            else:
-                root = "0 FILE " + files[1]
-                for sub_file in files[2:]:
-                    sub_name = sub_file.splitlines()[0].lower().strip()
-                    sub_str = "0 FILE" + sub_file
-                    self.sub_model_str[sub_name] = sub_str
-                    self.sub_models[sub_name] = get_parts_from_model(sub_str)
-            self.pli, self.steps = self.parse_model(root, is_top_level=True)
+        self.sub_model_str = {}
+        self.flatten_cache.clear()
+        self.sub_model_steps = {}
+        self.proxy_boms = {}
+        PART_ALIASES.refresh()
+        cache, key = None, None
+        if use_cache and self.cache_dir is not None:
+            cache = ParseCache(self.cache_dir, self.cache_max_bytes)
+            key = ParseCache.key(file_hash(self.filename), self.cache_params())
+            results = cache.load(key)
+            if results is not None:
+                try:
+                    self.restore_results(results)
+                    return
+                except CACHE_ERRORS:
+                    # results cached by another version are parsed again
+                    cache.remove(key)
+        self.index = LDRFileIndex.from_file(self.filename)
+        for sub_name in self.index.names[1:]:
+            sub_str = self.index.file_text(sub_name)
+            self.sub_model_str[sub_name] = sub_str
+            self.sub_models[sub_name] = get_parts_from_model(sub_str)
+        if self.dedup_submodels:
+            # identical submodels share one flattened table (only the
+            # geometry is shared, each submodel is parsed by its name)
+            aliases = self.submodel_graph().aliases()
+            self.flatten_cache.set_aliases(aliases, self.sub_models)
+        self.pli, self.steps = self.parse_model(self.index.root, is_top_level=True)
         self.unwrap()
+        if cache is not None:
+            cache.store(key, self.cached_results())
+
+    def cache_params(self):
+        """Returns a dictionary of the values which affect the parsed results
+        of a file and therefore form part of its cache key."""
+        params = {
+            k: getattr(self, k)
+            for k in self.PARAMS
+            if k not in ["cache_dir", "cache_max_bytes", "lazy"]
+        }
+        params["ignore_parts"] = getattr(self.bom, "ignore_parts", None)
+        params["special_tokens"] = sorted(META_MATCHER.tokens.items())
+        params["part_aliases"] = PART_ALIASES.digest()
+        return params
+
+    def cached_results(self):
+        """Returns a dictionary of the parsed results stored in the cache.
+        Rather than the step records with their lists of LDRPart objects,
+        only the columnar part store of each parsed model is stored with the
+        light fields of each step and the position of each unwrapped step,
+        so that the PLI and parts of the steps are only rebuilt (by
+        load_step) when they are accessed after the results are restored."""
+        models = [(None, self.steps)]
+        models.extend([(k, v[1]) for k, v in self.sub_model_steps.items()])
+        step_refs = {}
+        model_records = []
+        pli_boms = {}
+        for i, (key, steps) in enumerate(models):
+            store = None
+            records = []
+            for n, step in steps.items():
+                parts = step.parts
+                store = parts.store
+                records.append(
+                    (
+                        n,
+                        parts.end,
+                        parts.aspect,
+                        tuple([getattr(step, k) for k in LDRStep.CACHED_KEYS]),
+                        step._extra,
+                    )
+                )
+                step_refs[id(step)] = (i, n)
+                # the PLI BOMs of steps with proxy parts are completed by
+                # unwrap_model and so are stored as they are
+                if step.is_loaded and id(step.pli_bom) in self.proxy_boms:
+                    pli_boms[(i, n)] = step.pli_bom
+            model_records.append((key, store, records))
+        unwrapped = []
+        for e in self.unwrapped:
+            unwrapped.append(
+                (
+                    step_refs[id(e.source)],
+                    tuple([getattr(e, k) for k in LDRUnwrappedStep.OWN_KEYS]),
+                    e._extra,
+                )
+            )
+        return {
+            "index": self.index,
+            "sub_models": self.sub_models,
+            "models": model_records,
+            "pli_boms": pli_boms,
+            "unwrapped": unwrapped,
+            "callouts": self.callouts,
+            "bom": self.bom,
+            "continuous_step_count": self.continuous_step_count,
+        }
+
+    def restore_results(self, results):
+        """Restores the parsed results loaded from the cache.  The step
+        records are rebuilt as lazily loaded steps and the indexes are built
+        before the model is changed, so that the model is unchanged if the
+        results cannot be restored."""
+        models = []
+        for key, store, records in results["models"]:
+            steps = {}
+            start = 0
+            for n, end, aspect, values, extra in records:
+                step = LDRStep(
+                    loader=self.load_step,
+                    context=(store, start, end, None, None),
+                    parts=store.view(end, aspect),
+                    **dict(zip(LDRStep.CACHED_KEYS, values)),
+                )
+                step._extra = extra
+                steps[n] = step
+                start = end
+            models.append((key, steps))
+        for (i, n), pli_bom in results["pli_boms"].items():
+            models[i][1][n].pli_bom = pli_bom
+        unwrapped = []
+        for (i, n), values, extra in results["unwrapped"]:
+            e = LDRUnwrappedStep(
+                models[i][1][n], **dict(zip(LDRUnwrappedStep.OWN_KEYS, values))
+            )
+            e._extra = extra
+            unwrapped.append(e)
+        unwrapped_index = UnwrappedIndex(unwrapped)
+        callout_index = CalloutIndex(results["callouts"], unwrapped)
+        index = results["index"]
+        self.index = index
+        self.sub_models = results["sub_models"]
+        self.sub_model_str = {name: index.file_text(name) for name in index.names[1:]}
+        self.steps = models[0][1]
+        self.pli = StepPLI(self.steps)
+        self.sub_model_steps = {
+            key: (StepPLI(steps), steps) for key, steps in models[1:]
+        }
+        self.proxy_boms = {id(b): b for b in results["pli_boms"].values()}
+        self.unwrapped = unwrapped
+        self.callouts = results["callouts"]
+        self.bom = results["bom"]
+        self.continuous_step_count = results["continuous_step_count"]
+        self.unwrapped_index = unwrapped_index
+        self.callout_index = callout_index
+        if self.dedup_submodels:
+            aliases = self.submodel_graph().aliases()
+            self.flatten_cache.set_aliases(aliases, self.sub_models)
+
+    def step_texts(self, root):
+        """Returns the LDraw text of each step of a model.  The model is either
+        identified by its name in the file index built by parse_file or is
+        provided as a string of LDraw text."""
+        if self.index is not None and root in self.index:
+            return self.index.step_texts(root)
+        return LDRFileIndex(root).step_texts()
 
     def ad_hoc_parse(self, ldrstring, only_submodel=None):
         """Performs an adhoc parsing operation on a provided LDraw formatted text
@@ -971,12 +1684,15 @@ class LDRModel:
             model_parts,
             reset_parts=False,
             only_submodel=only_submodel,
+            cache=self.flatten_cache,
         )
         return model_parts
 
-    def parse_model(self, root, is_top_level=True, mask_submodels=False):
+    def parse_model(self, root, is_top_level=True, mask_submodels=False, lazy=None):
         """Generic parser for LDraw text. It parses a model provided either as a string
         of the entire LDR file at root level or as a key to a submodel in the LDR file.
+        The steps of models in the file parsed by parse_file are sliced directly
+        from its file index rather than by splitting a copy of the model text.
         In either case, it recursively traverses the LDraw tree including all the
         children of the desired model and returns two lists: one for the parts
         at each step and one representing the model at each step.
@@ -987,7 +1703,8 @@ class LDRModel:
            pli, steps = self.parse_model("submodel.ldr", is_top_level=False)
 
         The PLI list is a list of LDRPart objects for each step.
-        The steps list is list of dictionaries with the following data for each step:
+        The steps list is a list of LDRStep records (which can be accessed like
+        dictionaries) with the following data for each step:
             parts - the aggregate parts that form the model at the step
             step_parts - only the parts that have been added at the step
             sub_models - a list of submodels referred to in this step
@@ -1000,21 +1717,32 @@ class LDRModel:
             aspect_change - a flag indicating the aspect angle has changed
             sub_parts - parts added to this step that come from sub-models
                         indexed by submodel name in a dictionary
+
+        If lazy is True (or the lazy parameter of the model is set), each step
+        is only pre-scanned for its sub-models and meta commands and its part
+        count is found from the submodel graph.  No parts are flattened while
+        parsing.  The parts of a step are only flattened when the model at
+        that step (or a later step) is first accessed, continuing from the
+        last step flattened so far, and the PLI, step_parts, pli_bom and
+        sub_parts of a step are only computed by load_step when they are
+        accessed, e.g. from model[idx], steps[n] or pli[n].  The pre-scan of
+        every step (and unwrapping the model) is still done when parsing.
         """
+        lazy = lazy if lazy is not None else self.lazy
         is_masked = False
         if not is_top_level:
-            if root in self.sub_model_str:
-                root = self.sub_model_str[root]
-            else:
+            if not root in self.sub_model_str:
                 key = root + ".ldr"
                 if key in self.sub_model_str:
-                    root = self.sub_model_str[key]
+                    root = key
                     is_masked = True if mask_submodels else False
 
         model_pli = {}
         model_steps = {}
-        steps = root.split("0 STEP")
-        model_parts = []
+        steps = self.step_texts(root)
+        # the model at each step is stored as a view into an append-only
+        # store of parts, referring only to its end offset and aspect
+        model_store = CumulativeParts()
 
         current_aspect = self.global_aspect
         current_scale = self.global_scale
@@ -1026,8 +1754,7 @@ class LDRModel:
         for i, step in enumerate(steps):
             aspect_change = False
             proxy_parts = []
-            step_parts = get_parts_from_model(step)
-            meta_cmd = get_meta_commands(step)
+            step_parts, meta_cmd = scan_ldraw(step)
             for cmd in meta_cmd:
                 if "scale" in cmd:
                     current_scale = float(cmd["scale"]["values"][0])
@@ -1055,89 +1782,125 @@ class LDRModel:
                     )
                     aspect_change = True if step_num > 1 else False
                 elif "pli_proxy" in cmd:
-                    for item in cmd["pli_proxy"]["values"]:
-                        if "_" in item:
-                            sp = item.split("_")
-                            pname = sp[0]
-                            pcolour = sp[1]
-                        else:
-                            pname = item
-                            pcolour = LDR_DEF_COLOUR
-                        proxy_part = LDRPart(colour=pcolour, name=pname)
-                        proxy_parts.append(proxy_part)
+                    proxy_parts.extend(get_proxy_parts([cmd]))
 
             # capture submodel references in this step
             subs = []
             for p in step_parts:
                 if p["partname"] in self.sub_models:
                     subs.append(p["partname"])
-            # capture the parts that have been added in this step
-            # and store a transformed/normalized version for a PLI
-            parts_in_step = []
-            recursive_parse_model(
-                step_parts, self.sub_models, parts_in_step, reset_parts=True
-            )
-            pli = self.transform_parts_to(
-                parts_in_step,
-                origin=(0, 0, 0),
-                aspect=self.pli_aspect,
-                use_exceptions=True,
-            )
-            # check for proxy parts added to step for PLI
-            if len(proxy_parts) > 0:
-                proxy_parts = self.transform_parts_to(
-                    proxy_parts,
-                    origin=(0, 0, 0),
-                    aspect=self.pli_aspect,
-                    use_exceptions=True,
+            # capture the parts that have been added in this step, the
+            # transformed versions of these parts for the PLI and the step
+            # are built by load_step either now or when first accessed.
+            # The part counts of the submodel graph are the same as the
+            # number of flattened parts, so that in lazy mode the parts are
+            # only flattened by the model store when they are needed.
+            counts = None
+            if is_top_level or lazy:
+                counts = self.submodel_graph().model_counts(step_parts)
+            start = len(model_store)
+            if lazy:
+                loader = partial(
+                    flatten_model, step_parts, self.sub_models, cache=self.flatten_cache
                 )
-                pli.extend(proxy_parts)
-            # submodel parts stored in separate dictionaries for convenient
-            # access if required
-            sub_dict = {}
-            for sub in subs:
-                sub_parts = []
-                recursive_parse_model(
-                    step_parts,
-                    self.sub_models,
-                    sub_parts,
-                    reset_parts=True,
-                    only_submodel=sub,
+                end = model_store.defer(sum(counts.values()), loader)
+            else:
+                step_table = flatten_model(
+                    step_parts, self.sub_models, cache=self.flatten_cache
                 )
-                pn = self.transform_parts(sub_parts, aspect=current_aspect)
-                sub_dict[sub] = pn
-
-            step_dict = {}
-            if len(pli) > 0:
-                model_pli[step_num] = pli
-                # Store a BOM object representation of the parts for convenience
-                pli_bom = BOM()
-                pli_bom.ignore_parts = self.bom.ignore_parts
-                for p in pli:
-                    pli_bom.add_part(BOMPart(1, p.name, p.attrib.colour))
-                    if is_top_level:
-                        self.bom.add_part(BOMPart(1, p.name, p.attrib.colour))
+                end = start + len(step_table)
+            if end - start + len(proxy_parts) > 0:
+                if is_top_level:
+                    # the model BOM is counted from the submodel graph so that
+                    # repeated submodels are not expanded part by part
+                    counts = defaultdict(int, counts)
+                    for p in proxy_parts:
+                        counts[(p.name, p.attrib.colour)] += 1
+                    for (name, colour), qty in counts.items():
+                        self.bom.add_part(BOMPart(qty, name, colour))
                 # store the model representation
-                recursive_parse_model(
-                    step_parts, self.sub_models, model_parts, reset_parts=False
+                if not lazy:
+                    model_store.append(step_table)
+                p = model_store.view(end, current_aspect)
+                # put all the collection info into a step record
+                step_dict = LDRStep(
+                    loader=self.load_step,
+                    context=(model_store, start, end, step_parts, proxy_parts),
+                    parts=p,
+                    sub_models=subs,
+                    aspect=current_aspect,
+                    scale=current_scale,
+                    model_scale=model_scale,
+                    raw_ldraw=step,
+                    meta=meta_cmd,
+                    aspect_change=aspect_change,
                 )
-                p = self.transform_parts(model_parts, aspect=current_aspect)
-                # store only the parts added in this step
-                pn = self.transform_parts(parts_in_step, aspect=current_aspect)
-                # put all the collection info into a dictionary
-                step_dict["parts"] = p
-                step_dict["sub_models"] = subs
-                step_dict["aspect"] = current_aspect
-                step_dict["scale"] = current_scale
-                step_dict["model_scale"] = model_scale
-                step_dict["raw_ldraw"] = step
-                step_dict["step_parts"] = pn
-                step_dict["pli_bom"] = pli_bom
-                step_dict["meta"] = meta_cmd
-                step_dict["aspect_change"] = aspect_change
-                step_dict["sub_parts"] = sub_dict
+                if not lazy:
+                    step_dict.load()
+                    model_pli[step_num] = step_dict.pli
                 model_steps[step_num] = step_dict
                 step_num += 1
 
             progress_bar(i, len(steps), "Parsing:", length=50)
+        if lazy:
+            model_pli = StepPLI(model_steps)
         return model_pli, model_steps
+
+    def submodel_graph(self):
+        """Returns the SubmodelGraph of the model's submodels."""
+        if self.graph is None or self.graph.submodels is not self.sub_models:
+            self.graph = SubmodelGraph(self.sub_models)
+        return self.graph
+
+    def load_step(self, step):
+        """Returns the fields of a step record parsed by parse_model which are
+        expensive to compute, i.e. the PLI parts and BOM, and the parts added
+        in the step including those from each sub-model."""
+        model_store, start, end, step_parts, proxy_parts = step.context
+        if step_parts is None:
+            # a step restored from the cache is scanned again
+            step_parts = get_parts_from_model(step.raw_ldraw)
+            proxy_parts = get_proxy_parts(step.meta)
+        step_table = model_store.step_table(start, end)
+        # the parts are transformed as whole tables and are only converted
+        # to lists of LDRPart objects at the end
+        pli_table = self.transform_table_to(
+            step_table,
+            origin=(0, 0, 0),
+            aspect=self.pli_aspect,
+            use_exceptions=True,
+        )
+        pli = pli_table.to_parts()
+        # check for proxy parts added to step for PLI
+        if len(proxy_parts) > 0:
+            proxy_parts = self.transform_parts_to(
+                proxy_parts,
+                origin=(0, 0, 0),
+                aspect=self.pli_aspect,
+                use_exceptions=True,
+            )
+            pli.extend(proxy_parts)
+        # submodel parts stored in separate dictionaries for convenient
+        # access if required
+        sub_dict = {}
+        for sub in step.sub_models:
+            sub_table = flatten_model(
+                step_parts,
+                self.sub_models,
+                only_submodel=sub,
+                cache=self.flatten_cache,
+            )
+            sub_dict[sub] = self.transform_table(
+                sub_table, aspect=step.aspect
+            ).to_parts()
+        # Store a BOM object representation of the parts for convenience
+        pli_bom = BOM()
+        pli_bom.ignore_parts = self.bom.ignore_parts
+        counts = defaultdict(int, step_table.counts())
+        for p in proxy_parts:
+            counts[(p.name, p.attrib.colour)] += 1
+        for (name, colour), qty in counts.items():
+            pli_bom.add_part(BOMPart(qty, name, colour))
+        # store only the parts added in this step
+        pn = self.transform_table(step_table, aspect=step.aspect).to_parts()
+        return {"pli": pli, "step_parts": pn, "pli_bom": pli_bom, "sub_parts": sub_dict}
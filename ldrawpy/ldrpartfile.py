@@ -0,0 +1,314 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2020  Michael Gale
+# This file is part of the legocad python module.
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+# LDraw binary part table files
+
+import mmap
+import struct
+from collections.abc import Sequence
+
+import numpy as np
+
+from toolbox import *
+from ldrawpy import *
+from .ldrmodel import scan_model_parts
+from .ldrparttable import PartTable
+
+PART_FILE_EXT = ".ldrparts"
+PART_FILE_MAGIC = b"LDRPARTS"
+PART_FILE_VERSION = 2
+
+# magic, version, bytes per float value, number of proxy part counts
+# (reserved and always 0 in version 1), number of parts, number of steps
+# and length of the encoded name dictionary
+PART_FILE_HEADER = struct.Struct("<8sHHIQQQ")
+
+# bit flags stored for each part
+FLAG_WRAPCALLOUT = 1
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def _sections(header_size, n_parts, n_steps, names_len, float_bytes, n_proxies=0):
+    """Returns the (offset, dtype, shape) of each array section of a part
+    file in the order they are stored.  Each section is 8 byte aligned."""
+    ft = "<f%d" % (float_bytes)
+    layout = [
+        ("codes", "<i4", (n_parts,)),
+        ("colours", "<i4", (n_parts,)),
+        ("flags", "u1", (n_parts,)),
+        ("loc", ft, (n_parts, 3)),
+        ("matrix", ft, (n_parts, 3, 3)),
+        ("steps", "<i8", (n_steps,)),
+        ("proxies", "<i4", (n_proxies, 3)),
+    ]
+    sections = {}
+    offset = _align(header_size + names_len)
+    for name, dtype, shape in layout:
+        sections[name] = (offset, np.dtype(dtype), shape)
+        offset = _align(offset + np.dtype(dtype).itemsize * int(np.prod(shape)))
+    return sections, offset
+
+
+def _part_columns(parts):
+    """Returns a PartTable and an array of part flags for a PartTable, a
+    list of LDRPart objects or LDraw text lines.  The locations of parts in
+    mm units are converted to ldu."""
+    if isinstance(parts, PartTable):
+        return parts, np.zeros(len(parts), dtype=np.uint8)
+    parts = list(parts) if not isinstance(parts, str) else parts
+    if isinstance(parts, str) or (len(parts) > 0 and isinstance(parts[0], str)):
+        table = PartTable.from_lines(parts)
+        return table, np.zeros(len(table), dtype=np.uint8)
+    table = PartTable.from_parts(parts)
+    mm = np.array([p.attrib.units == "mm" for p in parts], dtype=bool)
+    if mm.any():
+        table.loc[mm] *= 2.5
+    flags = np.array(
+        [FLAG_WRAPCALLOUT if p.wrapcallout else 0 for p in parts], dtype=np.uint8
+    )
+    return table, flags
+
+
+def write_part_file(filename, parts, steps=None, dtype=np.float64, proxies=None):
+    """Writes parts to a compact binary part file.  parts can either be a
+    PartTable, a list of LDRPart objects or LDraw lines, or a list of these
+    with the parts of each step.  steps is an optional list of the end
+    offset of each step into the parts.  Locations and matrices are stored
+    as either float64 (the default, which reproduces the LDraw text of every
+    part exactly) or float32 (half the size, exact to about 7 significant
+    digits).  proxies is an optional dictionary of the quantity of PLI proxy
+    parts keyed by (name, colour) which are included in the part counts of
+    the file but have no location.  Returns the number of bytes written."""
+    float_bytes = np.dtype(dtype).itemsize
+    if float_bytes not in (4, 8):
+        raise ValueError("Part file values must be float32 or float64 not %s" % dtype)
+    if isinstance(parts, list) and len(parts) > 0:
+        step = parts[0]
+        if isinstance(step, (Sequence, PartTable)) and not isinstance(step, str):
+            columns = [_part_columns(e) for e in parts]
+            steps = np.cumsum([len(t) for t, _ in columns]).tolist()
+            table = PartTable.concat([t for t, _ in columns])
+            flags = np.concatenate([f for _, f in columns])
+            parts = None
+    if parts is not None:
+        table, flags = _part_columns(parts)
+    steps = steps if steps is not None else [len(table)]
+    # proxy part names are added to the name dictionary after the names of
+    # the parts in the table
+    names = list(table.categories)
+    codes = {name: code for code, name in enumerate(names)}
+    proxies = proxies if proxies is not None else {}
+    proxy_rows = []
+    for (name, colour), qty in sorted(proxies.items(), key=lambda e: str(e[0])):
+        if name not in codes:
+            codes[name] = len(names)
+            names.append(name)
+        proxy_rows.append((codes[name], int(colour), qty))
+    names = "\n".join(names).encode("utf-8")
+    header = PART_FILE_HEADER.pack(
+        PART_FILE_MAGIC,
+        PART_FILE_VERSION,
+        float_bytes,
+        len(proxy_rows),
+        len(table),
+        len(steps),
+        len(names),
+    )
+    sections, size = _sections(
+        PART_FILE_HEADER.size,
+        len(table),
+        len(steps),
+        len(names),
+        float_bytes,
+        len(proxy_rows),
+    )
+    columns = {
+        "codes": table.codes,
+        "colours": table.colours,
+        "flags": flags,
+        "loc": table.loc,
+        "matrix": table.matrix,
+        "steps": np.asarray(steps),
+        "proxies": np.array(proxy_rows).reshape((-1, 3)),
+    }
+    with open(filename, "wb") as fp:
+        fp.write(header)
+        fp.write(names)
+        for name, (offset, dt, shape) in sections.items():
+            fp.write(b"\0" * (offset - fp.tell()))
+            fp.write(np.ascontiguousarray(columns[name], dtype=dt).tobytes())
+        fp.write(b"\0" * (size - fp.tell()))
+    return size
+
+
+def write_model_part_file(source, filename, dtype=np.float64):
+    """Flattens the root model of an LDraw file (or any source accepted by
+    scan_model_parts) and writes its parts, transformed into the frame of
+    the root model, to a binary part file with the step offset of each
+    step and the counts of its PLI proxy parts.  The steps are numbered the
+    same as the steps of parse_model, i.e. steps without any parts are not
+    stored unless they add PLI proxy parts, in which case they are stored
+    as empty steps."""
+    steps, graph, proxies = scan_model_parts(source)
+    cache = FlattenCache()
+    tables = [flatten_model(parts, graph.submodels, cache=cache) for parts, _ in steps]
+    if len(tables) < 1:
+        return write_part_file(
+            filename, PartTable(), steps=[], dtype=dtype, proxies=proxies
+        )
+    return write_part_file(filename, tables, dtype=dtype, proxies=proxies)
+
+
+class PartFile:
+    """A binary part file opened with a read-only memory map.  The columns
+    of the part table are numpy arrays which refer directly to the mapped
+    file, so that even a very large model is opened without decoding any
+    LDraw text or copying its part data:
+        names - list of the unique part names (decoded when opened)
+        codes - int32 index into names for each part
+        colours - int32 LDraw colour codes
+        flags - uint8 part flags (e.g. FLAG_WRAPCALLOUT)
+        loc - N x 3 float32 or float64 part locations in ldu
+        matrix - N x 3 x 3 float32 or float64 part rotation matrices
+        steps - int64 end offset of each step into the parts
+        proxies - N x 3 int32 name index, colour and quantity of each PLI
+            proxy part (which has no location)
+    The arrays are read-only and must not be used after the file is closed."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as fp:
+            self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < PART_FILE_HEADER.size:
+            self.map.close()
+            raise ValueError("%s is not a LDraw part file" % (filename))
+        magic, version, float_bytes, n_proxies, n_parts, n_steps, names_len = (
+            PART_FILE_HEADER.unpack_from(self.map)
+        )
+        if not magic == PART_FILE_MAGIC:
+            self.map.close()
+            raise ValueError("%s is not a LDraw part file" % (filename))
+        if version > PART_FILE_VERSION:
+            self.map.close()
+            raise ValueError(
+                "%s is a version %d part file, only version %d or earlier is supported"
+                % (filename, version, PART_FILE_VERSION)
+            )
+        start = PART_FILE_HEADER.size
+        names = self.map[start : start + names_len].decode("utf-8")
+        self.names = names.split("\n") if names_len > 0 else []
+        self.float_bytes = float_bytes
+        sections, size = _sections(
+            start, n_parts, n_steps, names_len, float_bytes, n_proxies
+        )
+        if len(self.map) < size:
+            self.map.close()
+            raise ValueError("%s is a truncated LDraw part file" % (filename))
+        for name, (offset, dt, shape) in sections.items():
+            count = int(np.prod(shape))
+            array = np.frombuffer(self.map, dtype=dt, count=count, offset=offset)
+            setattr(self, name, array.reshape(shape))
+
+    def __str__(self):
+        return "PartFile: %s %d parts, %d steps, %d unique names, %d bytes" % (
+            self.filename,
+            len(self),
+            len(self.steps),
+            len(self.names),
+            len(self.map),
+        )
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Releases the arrays and closes the memory map.  If any arrays
+        (or tables) referring to the map are still in use, the map is closed
+        once they are no longer referenced."""
+        for name in ("codes", "colours", "flags", "loc", "matrix", "steps", "proxies"):
+            setattr(self, name, None)
+        try:
+            self.map.close()
+        except BufferError:
+            pass
+
+    def table(self, start=0, end=None):
+        """Returns a PartTable of the parts from start to end.  With float64
+        values the table columns are views of the mapped file."""
+        end = end if end is not None else len(self)
+        return PartTable._from_columns(
+            self.names,
+            self.codes[start:end],
+            self.colours[start:end],
+            self.loc[start:end].astype(np.float64, copy=False),
+            self.matrix[start:end].astype(np.float64, copy=False),
+        )
+
+    def step_range(self, step):
+        """Returns the (start, end) offset of the parts added in step,
+        numbered from 1."""
+        end = int(self.steps[step - 1])
+        start = int(self.steps[step - 2]) if step > 1 else 0
+        return start, end
+
+    def step_table(self, step, cumulative=False):
+        """Returns a PartTable of the parts added in step (numbered from 1)
+        or, if cumulative is True, of all the parts up to and including step."""
+        start, end = self.step_range(step)
+        return self.table(0 if cumulative else start, end)
+
+    def to_parts(self, start=0, end=None):
+        """Returns a list of LDRPart objects for the parts from start to end."""
+        end = end if end is not None else len(self)
+        parts = self.table(start, end).to_parts()
+        for p, flags in zip(parts, self.flags[start:end].tolist()):
+            p.wrapcallout = bool(flags & FLAG_WRAPCALLOUT)
+        return parts
+
+    def proxy_counts(self):
+        """Returns a dictionary of the quantity of each PLI proxy part keyed
+        by (name, colour) tuples."""
+        return {
+            (self.names[code], colour): qty
+            for code, colour, qty in self.proxies.tolist()
+        }
+
+    def counts(self, proxies=True):
+        """Returns a dictionary of the quantity of each unique part keyed
+        by (name, colour) tuples.  The counts include the PLI proxy parts
+        unless proxies is False, i.e. the counts of a file written by
+        write_model_part_file are the same as file_part_counts."""
+        counts = self.table().counts()
+        if proxies:
+            for key, qty in self.proxy_counts().items():
+                counts[key] = counts.get(key, 0) + qty
+        return counts
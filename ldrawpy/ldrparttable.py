@@ -0,0 +1,528 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2020  Michael Gale
+# This file is part of the legocad python module.
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+# Columnar LDraw part table
+
+import sys
+from collections import OrderedDict, deque
+from collections.abc import Sequence
+
+import numpy as np
+
+from toolbox import *
+from ldrawpy import *
+from .ldrhelpers import parse_part_lines
+from .ldrrotation import rotation_array, shared_matrix
+
+
+def matrix_array(matrix):
+    """Returns a 3 x 3 numpy array from a toolbox Matrix or a nested sequence."""
+    if isinstance(matrix, Matrix):
+        matrix = matrix.rows
+    return np.asarray(matrix, dtype=np.float64).reshape((3, 3))
+
+
+def vector_array(vector):
+    """Returns a numpy array of 3 values from a toolbox Vector or a sequence."""
+    if isinstance(vector, Vector):
+        vector = (vector.x, vector.y, vector.z)
+    return np.asarray(vector, dtype=np.float64).reshape(3)
+
+
+class PartTable:
+    """Columnar storage for a large number of LDraw parts.  Rather than an
+    LDRPart object (with its LDRAttrib, Vector and Matrix) for each part, the
+    parts are stored in a few contiguous arrays:
+        names - categorical part names stored as int32 codes into a list
+                of unique interned name strings (categories)
+        colours - int32 LDraw colour codes
+        loc - N x 3 float64 part locations
+        matrix - N x 3 x 3 float64 part rotation matrices
+    A PartTable can be converted to and from a list of LDRPart objects and
+    supports slicing, boolean masks, index arrays and concatenation."""
+
+    def __init__(self, names=None, colours=None, loc=None, matrix=None):
+        names = names if names is not None else []
+        n = len(names)
+        lookup = {}
+        self.categories = []
+        codes = np.empty(n, dtype=np.int32)
+        for i, name in enumerate(names):
+            if name not in lookup:
+                lookup[name] = len(self.categories)
+                self.categories.append(sys.intern(name))
+            codes[i] = lookup[name]
+        self.codes = codes
+        if colours is not None:
+            self.colours = np.asarray(colours, dtype=np.int32).reshape(n)
+        else:
+            self.colours = np.full(n, LDR_DEF_COLOUR, dtype=np.int32)
+        if loc is not None:
+            self.loc = np.asarray(loc, dtype=np.float64).reshape((n, 3))
+        else:
+            self.loc = np.zeros((n, 3), dtype=np.float64)
+        if matrix is not None:
+            self.matrix = np.asarray(matrix, dtype=np.float64).reshape((n, 3, 3))
+        else:
+            self.matrix = np.tile(np.eye(3), (n, 1, 1))
+
+    def __str__(self):
+        return "".join([str(p) for p in self])
+
+    def __repr__(self):
+        return "PartTable: %d parts, %d unique names, %d bytes" % (
+            len(self),
+            len(self.categories),
+            self.nbytes,
+        )
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __iter__(self):
+        return iter(self.to_parts())
+
+    def __getitem__(self, key):
+        """Returns an LDRPart for an integer key or a new PartTable for a
+        slice, boolean mask or array of indices."""
+        if isinstance(key, (int, np.integer)):
+            return self.part(key)
+        return self._from_columns(
+            self.categories,
+            self.codes[key],
+            self.colours[key],
+            self.loc[key],
+            self.matrix[key],
+        )
+
+    @classmethod
+    def _from_columns(cls, categories, codes, colours, loc, matrix):
+        table = cls.__new__(cls)
+        table.categories = categories
+        table.codes = codes
+        table.colours = colours
+        table.loc = loc
+        table.matrix = matrix
+        return table
+
+    @classmethod
+    def from_parts(cls, parts):
+        """Returns a PartTable from a list of LDRPart objects, a list of
+        LDraw text lines or a string of line feed delimited LDraw lines."""
+        if isinstance(parts, PartTable):
+            return parts.copy()
+        parts = list(parts) if not isinstance(parts, str) else parts
+        if isinstance(parts, str) or (len(parts) > 0 and isinstance(parts[0], str)):
+            return cls.from_lines(parts)
+        return cls(
+            names=[p.name for p in parts],
+            colours=[p.attrib.colour for p in parts],
+            loc=[(v.x, v.y, v.z) for v in [p.attrib.peek_loc() for p in parts]],
+            matrix=[p.attrib.peek_matrix().rows for p in parts],
+        )
+
+    @classmethod
+    def from_lines(cls, lines):
+        """Returns a PartTable decoded directly from LDraw type 1 lines without
+        creating LDRPart objects.  Lines which are not type 1 are skipped."""
+        decoded = [e for e in parse_part_lines(lines) if e is not None]
+        values = [e[1] for e in decoded]
+        return cls(
+            names=[e[2] for e in decoded],
+            colours=[e[0] for e in decoded],
+            loc=[v[0:3] for v in values],
+            matrix=[v[3:12] for v in values],
+        )
+
+    @classmethod
+    def concat(cls, tables):
+        """Returns a new PartTable with the parts of several tables joined
+        in order.  The name categories of the tables are merged."""
+        tables = list(tables)
+        if len(tables) < 1:
+            return cls()
+        categories = list(tables[0].categories)
+        lookup = {name: i for i, name in enumerate(categories)}
+        remaps = {}
+        codes = []
+        for table in tables:
+            if table.categories is tables[0].categories:
+                codes.append(table.codes)
+                continue
+            # tables often share the same categories, e.g. many instances
+            # of the same sub-model, so each is only remapped once
+            key = id(table.categories)
+            if key not in remaps:
+                remap = np.empty(len(table.categories), dtype=np.int32)
+                for i, name in enumerate(table.categories):
+                    if name not in lookup:
+                        lookup[name] = len(categories)
+                        categories.append(name)
+                    remap[i] = lookup[name]
+                remaps[key] = remap
+            codes.append(remaps[key][table.codes])
+        return cls._from_columns(
+            categories,
+            np.concatenate(codes),
+            np.concatenate([t.colours for t in tables]),
+            np.concatenate([t.loc for t in tables]),
+            np.concatenate([t.matrix for t in tables]),
+        )
+
+    def __add__(self, other):
+        return PartTable.concat([self, other])
+
+    @property
+    def names(self):
+        """Returns an array of the part name of each part."""
+        return np.array(self.categories, dtype=object)[self.codes]
+
+    @property
+    def nbytes(self):
+        return (
+            self.codes.nbytes
+            + self.colours.nbytes
+            + self.loc.nbytes
+            + self.matrix.nbytes
+        )
+
+    def copy(self):
+        return self._from_columns(
+            list(self.categories),
+            self.codes.copy(),
+            self.colours.copy(),
+            self.loc.copy(),
+            self.matrix.copy(),
+        )
+
+    def transform(self, matrix=None, offset=None):
+        """Returns a new PartTable with every part transformed by matrix and then
+        moved by offset, i.e. the equivalent of LDRPart.transform for all parts
+        with a single batched matrix multiplication."""
+        mats, locs = self.matrix, self.loc
+        if matrix is not None:
+            m = matrix_array(matrix)
+            mats = np.matmul(m, mats)
+            locs = np.matmul(locs, m.T)
+        if offset is not None:
+            locs = locs + vector_array(offset)
+        return self._from_columns(self.categories, self.codes, self.colours, locs, mats)
+
+    def rotate_by(self, angle):
+        """Returns a new PartTable with every part rotated by an euler angle,
+        i.e. the equivalent of LDRPart.rotate_by for all parts."""
+        return self.transform(matrix=rotation_array(angle))
+
+    def move_by(self, offset):
+        """Returns a new PartTable with every part moved by offset."""
+        return self.transform(offset=offset)
+
+    def set_rotation(self, matrix):
+        """Returns a new PartTable with the rotation matrix of every part
+        replaced by matrix, either a single 3 x 3 matrix for all the parts or
+        an N x 3 x 3 array with a matrix for each part."""
+        if isinstance(matrix, Matrix):
+            matrix = matrix_array(matrix)
+        mats = np.asarray(matrix, dtype=np.float64)
+        mats = np.broadcast_to(mats, (len(self), 3, 3)).copy()
+        return self._from_columns(
+            self.categories, self.codes, self.colours, self.loc, mats
+        )
+
+    def move_to(self, pos):
+        """Returns a new PartTable with every part moved to location pos."""
+        locs = np.tile(vector_array(pos), (len(self), 1))
+        return self._from_columns(
+            self.categories, self.codes, self.colours, locs, self.matrix
+        )
+
+    def change_colour(self, colour):
+        """Returns a new PartTable with every part changed to colour."""
+        colours = np.full(len(self), colour, dtype=np.int32)
+        return self._from_columns(
+            self.categories, self.codes, colours, self.loc, self.matrix
+        )
+
+    def instances(self, matrices, offsets):
+        """Returns a list of new PartTables, one for each placement of this
+        table with the corresponding transform matrix and offset.  All of the
+        placements are computed together with batched matrix multiplications
+        and the returned tables share the name categories of this table."""
+        ms = np.asarray(matrices, dtype=np.float64).reshape((-1, 3, 3))
+        os = np.asarray(offsets, dtype=np.float64).reshape((-1, 3))
+        mats = np.matmul(ms[:, None, :, :], self.matrix[None, :, :, :])
+        locs = np.einsum("kij,nj->kni", ms, self.loc) + os[:, None, :]
+        return [
+            self._from_columns(
+                self.categories, self.codes, self.colours, locs[k], mats[k]
+            )
+            for k in range(len(ms))
+        ]
+
+    def filter(self, mask):
+        """Returns a new PartTable with only the parts selected by mask."""
+        return self[np.asarray(mask, dtype=bool)]
+
+    def name_mask(self, names):
+        """Returns a boolean mask of the parts whose name is in names."""
+        names = set(names) if not isinstance(names, str) else set([names])
+        selected = np.array([c in names for c in self.categories], dtype=bool)
+        if len(selected) < 1:
+            return np.zeros(len(self), dtype=bool)
+        return selected[self.codes]
+
+    def counts(self):
+        """Returns a dictionary of the quantity of each unique part keyed
+        by (name, colour) tuples."""
+        if len(self) < 1:
+            return {}
+        keys = np.stack([self.codes.astype(np.int64), self.colours], axis=1)
+        uniq, qty = np.unique(keys, axis=0, return_counts=True)
+        return {
+            (self.categories[code], int(colour)): int(n)
+            for (code, colour), n in zip(uniq.tolist(), qty.tolist())
+        }
+
+    def part(self, idx):
+        """Returns an LDRPart object for the part at index idx."""
+        p = LDRPart(
+            colour=int(self.colours[idx]), name=self.categories[self.codes[idx]]
+        )
+        p.attrib.loc = Vector(*self.loc[idx].tolist())
+        p.attrib.share(matrix=shared_matrix(self.matrix[idx].ravel().tolist()))
+        return p
+
+    def to_parts(self):
+        """Returns a list of LDRPart objects for every part in the table."""
+        parts = []
+        categories = self.categories
+        for code, colour, loc, matrix in zip(
+            self.codes.tolist(),
+            self.colours.tolist(),
+            self.loc.tolist(),
+            self.matrix.reshape(-1, 9).tolist(),
+        ):
+            p = LDRPart(colour=colour, name=categories[code])
+            p.attrib.loc = Vector(*loc)
+            p.attrib.share(matrix=shared_matrix(matrix))
+            parts.append(p)
+        return parts
+
+
+class PartBuffer:
+    """Append-only columnar buffer of parts.  The arrays grow geometrically
+    so that appending is amortized O(1) per part, and a PartTable of any
+    prefix of the buffer is returned as a view without copying."""
+
+    def __init__(self, capacity=64):
+        self.categories = []
+        self.lookup = {}
+        self.length = 0
+        self.codes = np.empty(capacity, dtype=np.int32)
+        self.colours = np.empty(capacity, dtype=np.int32)
+        self.loc = np.empty((capacity, 3), dtype=np.float64)
+        self.matrix = np.empty((capacity, 3, 3), dtype=np.float64)
+
+    def __len__(self):
+        return self.length
+
+    def __getstate__(self):
+        # only the used part of the arrays is pickled
+        state = dict(self.__dict__)
+        for key in ("codes", "colours", "loc", "matrix"):
+            state[key] = state[key][: self.length].copy()
+        return state
+
+    def _reserve(self, n):
+        capacity = max(len(self.codes), 64)
+        if n <= capacity:
+            return
+        while capacity < n:
+            capacity *= 2
+        for key in ("codes", "colours", "loc", "matrix"):
+            old = getattr(self, key)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[: self.length] = old[: self.length]
+            setattr(self, key, new)
+
+    def append(self, table):
+        """Appends the parts of a PartTable to the end of the buffer."""
+        n = len(table)
+        if n < 1:
+            return
+        remap = np.empty(len(table.categories), dtype=np.int32)
+        for i, name in enumerate(table.categories):
+            if name not in self.lookup:
+                self.lookup[name] = len(self.categories)
+                self.categories.append(name)
+            remap[i] = self.lookup[name]
+        start, end = self.length, self.length + n
+        self._reserve(end)
+        self.codes[start:end] = remap[table.codes]
+        self.colours[start:end] = table.colours
+        self.loc[start:end] = table.loc
+        self.matrix[start:end] = table.matrix
+        self.length = end
+
+    def table(self, start=0, end=None):
+        """Returns a PartTable view of the parts from start to end."""
+        end = self.length if end is None else min(end, self.length)
+        return PartTable._from_columns(
+            self.categories,
+            self.codes[start:end],
+            self.colours[start:end],
+            self.loc[start:end],
+            self.matrix[start:end],
+        )
+
+
+class CumulativeParts:
+    """Persistent storage of the model at each step of a building sequence.
+    Rather than storing a full transformed copy of every part placed so far
+    at each step, the parts added in each step are appended once to a shared
+    buffer and each step only refers to its end offset and viewing aspect.
+    Copies of the buffer rotated to an aspect are kept as checkpoints which
+    are extended with only the newly added parts while the aspect is
+    unchanged, and a new rotation is only made when the aspect changes.
+
+    The parts of a step can also be deferred with a known part count and a
+    loader function.  Deferred steps are only loaded (in order, from the end
+    of the parts loaded so far) when the parts up to them are first needed."""
+
+    def __init__(self, max_aspects=2):
+        self.max_aspects = max_aspects
+        self.base = PartBuffer()
+        self.rotated = OrderedDict()
+        self.pending = deque()
+        self.end = 0
+
+    def __len__(self):
+        return self.end
+
+    def __getstate__(self):
+        # deferred loaders are not stored, the parts are loaded first, and
+        # the rotated checkpoints are not stored since they are rebuilt from
+        # the base parts when they are needed
+        self.fill()
+        state = dict(self.__dict__)
+        state["rotated"] = OrderedDict()
+        return state
+
+    def append(self, table):
+        """Appends the (untransformed) parts added in a step and returns
+        the new end offset of the model."""
+        self.fill()
+        self.base.append(table)
+        self.end = len(self.base)
+        return self.end
+
+    def defer(self, count, loader):
+        """Reserves count parts for a step which are provided by calling
+        loader() when they are first needed and returns the new end offset
+        of the model."""
+        if count > 0:
+            self.end += count
+            self.pending.append((self.end, loader))
+        return self.end
+
+    def fill(self, end=None):
+        """Loads any deferred steps up to end (or all of them)."""
+        while self.pending and (end is None or len(self.base) < end):
+            step_end, loader = self.pending.popleft()
+            table = loader()
+            if not len(self.base) + len(table) == step_end:
+                raise ValueError(
+                    "Deferred step has %d parts rather than the %d reserved"
+                    % (len(table), step_end - len(self.base))
+                )
+            self.base.append(table)
+
+    def step_table(self, start, end):
+        """Returns a PartTable of the (untransformed) parts from start to end."""
+        self.fill(end)
+        return self.base.table(start, end)
+
+    def table(self, end, aspect):
+        """Returns a PartTable of the first end parts rotated to aspect."""
+        self.fill(end)
+        key = tuple(aspect)
+        if key in self.rotated:
+            self.rotated.move_to_end(key)
+        else:
+            self.rotated[key] = PartBuffer()
+            while len(self.rotated) > self.max_aspects:
+                self.rotated.popitem(last=False)
+        checkpoint = self.rotated[key]
+        if len(checkpoint) < end:
+            rm = rotation_array(key)
+            checkpoint.append(self.base.table(len(checkpoint), end).transform(rm))
+        return checkpoint.table(0, end)
+
+    def view(self, end, aspect):
+        """Returns a CumulativePartsView of the model at end and aspect."""
+        return CumulativePartsView(self, end, aspect)
+
+
+class CumulativePartsView(Sequence):
+    """A read-only sequence of the LDRPart objects which make up a model at
+    a step.  The parts are only materialized from the shared CumulativeParts
+    storage when they are accessed."""
+
+    __slots__ = ("store", "end", "aspect")
+
+    def __init__(self, store, end, aspect):
+        self.store = store
+        self.end = end
+        self.aspect = tuple(aspect)
+
+    def __repr__(self):
+        return "CumulativePartsView: %d parts at aspect %s" % (self.end, self.aspect)
+
+    def __str__(self):
+        return "".join([str(p) for p in self])
+
+    def __len__(self):
+        return self.end
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.table[key].to_parts()
+        if key < 0:
+            key += self.end
+        if key < 0 or key >= self.end:
+            raise IndexError("part index out of range")
+        return self.table.part(key)
+
+    def __iter__(self):
+        return iter(self.table.to_parts())
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    @property
+    def table(self):
+        """Returns a PartTable of the parts in this view."""
+        return self.store.table(self.end, self.aspect)
@@ -24,40 +24,109 @@
 # LDraw primitives
 
 import hashlib
+import sys
 
 from functools import reduce
 
 from toolbox import *
 from ldrawpy import *
-from .ldrhelpers import vector_str, mat_str, quantize
+from .ldrhelpers import vector_str, mat_str, quantize, parse_part_line
+from .ldrrotation import euler_rotation, shared_matrix
+
+# the default location and orientation shared by every attribute which has
+# not been explicitly placed.  These are never modified in place.
+ORIGIN = Vector(0, 0, 0)
+IDENTITY_MATRIX = shared_matrix((1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0))
+
+# bit flags of LDRAttrib.owned
+OWN_LOC = 1
+OWN_MATRIX = 2
 
 
 class LDRAttrib:
-    __slots__ = ["colour", "units", "loc", "matrix"]
+    """Colour, units, location and orientation of an LDraw element.
+    The loc Vector and matrix are allocated lazily and are shared
+    copy-on-write: copies and parsed parts refer to the same (often
+    interned) objects until loc or matrix is accessed through its
+    attribute, at which point a private copy is made so that it can be
+    safely modified in place.  Use peek_loc and peek_matrix for read-only
+    access without copying."""
+
+    __slots__ = ["colour", "units", "_loc", "_matrix", "owned"]
 
     def __init__(self, colour=LDR_DEF_COLOUR, units="ldu"):
         self.colour = int(colour)
         self.units = units
-        self.loc = Vector(0, 0, 0)
-        self.matrix = Identity()
+        self._loc = None
+        self._matrix = None
+        self.owned = 0
 
     def __eq__(self, other):
         if not isinstance(other, self.__class__):
             return False
         if not self.colour == other.colour:
             return False
-        if not self.loc.almost_same_as(other.loc):
+        if not self.peek_loc().almost_same_as(other.peek_loc()):
             return False
-        if not self.matrix.is_almost_same_as(other.matrix):
+        if not self.peek_matrix().is_almost_same_as(other.peek_matrix()):
             return False
         return True
 
+    @property
+    def loc(self):
+        if not self.owned & OWN_LOC:
+            self._loc = self._loc.copy() if self._loc is not None else Vector(0, 0, 0)
+            self.owned |= OWN_LOC
+        return self._loc
+
+    @loc.setter
+    def loc(self, loc):
+        self._loc = loc
+        self.owned |= OWN_LOC
+
+    @property
+    def matrix(self):
+        if not self.owned & OWN_MATRIX:
+            self._matrix = (
+                self._matrix.copy() if self._matrix is not None else Identity()
+            )
+            self.owned |= OWN_MATRIX
+        return self._matrix
+
+    @matrix.setter
+    def matrix(self, matrix):
+        self._matrix = matrix
+        self.owned |= OWN_MATRIX
+
+    def peek_loc(self):
+        """Returns the location Vector without copying it.  It must not be
+        modified in place."""
+        return self._loc if self._loc is not None else ORIGIN
+
+    def peek_matrix(self):
+        """Returns the orientation Matrix without copying it.  It must not
+        be modified in place."""
+        return self._matrix if self._matrix is not None else IDENTITY_MATRIX
+
+    def share(self, loc=None, matrix=None):
+        """Assigns a loc Vector and/or matrix which may be shared with other
+        attributes.  They are copied before they are ever modified."""
+        if loc is not None:
+            self._loc = loc
+            self.owned &= ~OWN_LOC
+        if matrix is not None:
+            self._matrix = matrix
+            self.owned &= ~OWN_MATRIX
+
     def copy(self):
-        a = LDRAttrib()
+        a = LDRAttrib.__new__(LDRAttrib)
         a.colour = self.colour
         a.units = self.units
-        a.loc = self.loc.copy()
-        a.matrix = self.matrix.copy()
+        a._loc = self._loc
+        a._matrix = self._matrix
+        # both attributes now share loc and matrix until either modifies them
+        a.owned = 0
+        self.owned = 0
         return a
 
 
@@ -149,15 +218,25 @@ class LDRQuad:
 
 
 class LDRPart:
-    __slots__ = ["attrib", "name", "wrapcallout"]
+    __slots__ = ["attrib", "_name", "wrapcallout"]
 
     def __init__(self, colour=LDR_DEF_COLOUR, name=None, units="ldu"):
         self.attrib = LDRAttrib(colour, units)
         self.name = name if name is not None else ""
         self.wrapcallout = False
 
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        # part names repeat across many parts and are interned
+        self._name = sys.intern(name) if type(name) is str else name
+
     def __str__(self):
-        tup = tuple(reduce(lambda row1, row2: row1 + row2, self.attrib.matrix.rows))
+        attrib = self.attrib
+        tup = tuple(reduce(lambda row1, row2: row1 + row2, attrib.peek_matrix().rows))
         name = self.name
         ext = name[-4:].lower()
         name = self.name
@@ -167,8 +246,8 @@ class LDRPart:
         else:
             name += ".dat"
         s = (
-            ("1 %i " % self.attrib.colour)
-            + vector_str(self.attrib.loc, self.attrib)
+            ("1 %i " % attrib.colour)
+            + vector_str(attrib.peek_loc(), attrib)
             + mat_str(tup)
             + ("%s\n" % name)
         )
@@ -186,8 +265,8 @@ class LDRPart:
         return True
 
     def copy(self):
-        p = LDRPart()
-        p.name = self.name
+        p = LDRPart.__new__(LDRPart)
+        p._name = self._name
         p.wrapcallout = self.wrapcallout
         p.attrib = self.attrib.copy()
         return p
@@ -214,7 +293,7 @@ class LDRPart:
             if not self.attrib.colour == other.attrib.colour:
                 return False
         if not ignore_location:
-            if not self.attrib.loc.almost_same_as(other.attrib.loc):
+            if not self.attrib.peek_loc().almost_same_as(other.attrib.peek_loc()):
                 return False
         if not ignore_colour and not ignore_location:
             if not self.sha1hash() == other.sha1hash():
@@ -222,8 +301,8 @@ class LDRPart:
         return True
 
     def is_coaligned(self, other):
-        v1 = self.attrib.loc * self.attrib.matrix
-        v2 = other.attrib.loc * other.attrib.matrix
+        v1 = self.attrib.peek_loc() * self.attrib.peek_matrix()
+        v2 = other.attrib.peek_loc() * other.attrib.peek_matrix()
         naxis = v1.is_colinear_with(v2)
         if naxis == 2:
             return True
@@ -233,8 +312,7 @@ class LDRPart:
         self.attrib.colour = to_colour
 
     def set_rotation(self, angle):
-        rm = euler_to_rot_matrix(angle)
-        self.attrib.matrix = rm
+        self.attrib.share(matrix=euler_rotation(angle).matrix)
 
     def move_to(self, pos):
         o = safe_vector(pos)
@@ -242,52 +320,27 @@ class LDRPart:
 
     def move_by(self, offset):
         o = safe_vector(offset)
-        self.attrib.loc += o
+        self.attrib.loc = self.attrib.peek_loc() + o
 
     def rotate_by(self, angle):
-        rm = euler_to_rot_matrix(angle)
-        rt = rm.transpose()
-        self.attrib.matrix = rm * self.attrib.matrix
-        self.attrib.loc *= rt
+        rot = euler_rotation(angle)
+        self.attrib.matrix = rot.matrix * self.attrib.peek_matrix()
+        self.attrib.loc = self.attrib.peek_loc() * rot.transpose
 
     def transform(self, matrix=Identity(), offset=Vector(0, 0, 0)):
         mt = matrix.transpose()
-        self.attrib.matrix = matrix * self.attrib.matrix
-        self.attrib.loc *= mt
-        self.attrib.loc += offset
+        self.attrib.matrix = matrix * self.attrib.peek_matrix()
+        self.attrib.loc = self.attrib.peek_loc() * mt + offset
 
     def from_str(self, s):
-        split_line = s.lower().split()
-        if not len(split_line) >= 15:
+        fields = parse_part_line(s)
+        if fields is None:
             return None
-        line_type = int(split_line[0].lstrip())
-        if not line_type == 1:
-            return None
-        self.attrib.colour = int(split_line[1])
-        self.attrib.loc.x = quantize(split_line[2])
-        self.attrib.loc.y = quantize(split_line[3])
-        self.attrib.loc.z = quantize(split_line[4])
-        self.attrib.matrix = Matrix(
-            [
-                [
-                    quantize(split_line[5]),
-                    quantize(split_line[6]),
-                    quantize(split_line[7]),
-                ],
-                [
-                    quantize(split_line[8]),
-                    quantize(split_line[9]),
-                    quantize(split_line[10]),
-                ],
-                [
-                    quantize(split_line[11]),
-                    quantize(split_line[12]),
-                    quantize(split_line[13]),
-                ],
-            ]
-        )
-        pname = " ".join(split_line[14:])
-        self.name = pname.replace(".dat", "")
+        colour, v, name = fields
+        self.attrib.colour = colour
+        self.attrib.loc = Vector(v[0], v[1], v[2])
+        self.attrib.share(matrix=shared_matrix(v[3:12]))
+        self.name = name
         return self
 
     @staticmethod
@@ -305,7 +358,7 @@ class LDRPart:
         p = LDRPart()
         p.from_str(s)
         mt = matrix.transpose()
-        p.attrib.matrix = matrix * p.attrib.matrix
+        p.attrib.matrix = matrix * p.attrib.peek_matrix()
         p.attrib.loc *= mt
         p.attrib.loc += offset
         p.wrapcallout = False
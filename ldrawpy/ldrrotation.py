@@ -0,0 +1,160 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2020  Michael Gale
+# This file is part of the legocad python module.
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+# Shared cache of rotation matrices
+
+
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+from toolbox import *
+
+# a cached rotation matrix and its transpose as toolbox Matrix objects (which
+# must not be modified in place) and as read-only numpy arrays
+RotationEntry = namedtuple("RotationEntry", "rows matrix transpose array array_t")
+
+
+def quantize_angle(angle):
+    """Returns an euler angle as a tuple of floats rounded to 4 decimal
+    places for use as a cache key."""
+    if isinstance(angle, Vector):
+        angle = (angle.x, angle.y, angle.z)
+    return tuple([round(float(a), 4) for a in angle])
+
+
+class RotationCache:
+    """A bounded, thread-safe least recently used cache of rotation matrices.
+    Entries are computed once by a factory function which returns a toolbox
+    Matrix and are stored with their transpose as immutable RotationEntry
+    tuples.  The cache keeps count of its hits and misses."""
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __str__(self):
+        return "RotationCache: %d entries, %d hits, %d misses (%.1f%% hit rate)" % (
+            len(self),
+            self.hits,
+            self.misses,
+            100.0 * self.hit_rate,
+        )
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def stats(self):
+        """Returns a dictionary of the cache statistics."""
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hit_rate,
+            }
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def get(self, key, factory):
+        """Returns the RotationEntry for key, calling factory() to compute
+        the rotation Matrix if it is not cached."""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+        m = factory()
+        rows = tuple([tuple([float(v) for v in row]) for row in m.rows])
+        array = np.array(rows, dtype=np.float64)
+        array.setflags(write=False)
+        array_t = array.T.copy()
+        array_t.setflags(write=False)
+        entry = RotationEntry(
+            rows, Matrix([list(r) for r in rows]), m.transpose(), array, array_t
+        )
+        with self.lock:
+            self.entries[key] = entry
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return entry
+
+
+ROTATION_CACHE = RotationCache()
+
+
+def euler_rotation(angle):
+    """Returns the cached RotationEntry for an euler angle."""
+    key = quantize_angle(angle)
+    return ROTATION_CACHE.get(key, lambda: euler_to_rot_matrix(key))
+
+
+def rotation_matrix(angle):
+    """Returns a new toolbox Matrix for an euler angle from the cache."""
+    return Matrix([list(r) for r in euler_rotation(angle).rows])
+
+
+def rotation_array(angle):
+    """Returns a read-only 3 x 3 numpy array for an euler angle."""
+    return euler_rotation(angle).array
+
+
+# toolbox Matrix objects shared by value between parts, keyed by their 9
+# values in row order.  Shared matrices must never be modified in place.
+SHARED_MATRICES = {}
+MAX_SHARED_MATRICES = 65536
+
+
+def shared_matrix(values):
+    """Returns a shared (interned) toolbox Matrix for a sequence of 9 matrix
+    values in row order.  Most parts use one of a small number of axis
+    aligned rotations and therefore share a single Matrix object.  Once the
+    intern table is full, a new unshared Matrix is returned instead."""
+    key = tuple(values)
+    m = SHARED_MATRICES.get(key, None)
+    if m is not None:
+        return m
+    m = Matrix([list(key[0:3]), list(key[3:6]), list(key[6:9])])
+    if len(SHARED_MATRICES) < MAX_SHARED_MATRICES:
+        m = SHARED_MATRICES.setdefault(key, m)
+    return m
+
+
+def rotation_cache_stats():
+    """Returns a dictionary of the statistics of the rotation matrix cache."""
+    return ROTATION_CACHE.stats()
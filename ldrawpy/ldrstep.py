@@ -0,0 +1,296 @@
+#! /usr/bin/env python3
+#
+# Copyright (C) 2020  Michael Gale
+# This file is part of the legocad python module.
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+# LDraw model step records
+
+from collections.abc import Mapping, MutableMapping
+
+
+class _Deleted:
+    # marks a key of a record which has been deleted, it is pickled by
+    # name so that the marker is the same object when a record is restored
+    def __reduce__(self):
+        return "_DELETED"
+
+
+_DELETED = _Deleted()
+
+
+class SlottedRecord(MutableMapping):
+    """Base class for compact records which store a fixed set of keys as
+    slots rather than in a dictionary.  Records are mutable mappings which
+    support the same access as the dictionaries they replace, e.g.
+    step["parts"], "meta" in step, step.items(), step.update(...),
+    step.pop(...) and {**step}.  Keys which are not one of the record's
+    slots can also be assigned and are kept in a small dictionary which is
+    only created when it is first needed.  This dictionary also records
+    any of the record's own keys which have been deleted."""
+
+    __slots__ = ("_extra",)
+    KEYS = ()
+    _fields = frozenset()
+
+    def __repr__(self):
+        return "%s(%s)" % (
+            type(self).__name__,
+            ", ".join(["%s=%r" % (k, v) for k, v in self.items()]),
+        )
+
+    def __getitem__(self, key):
+        if self._extra is not None and key in self._extra:
+            value = self._extra[key]
+            if value is _DELETED:
+                raise KeyError(key)
+            return value
+        if key in self._fields:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self._fields:
+            setattr(self, key, value)
+            if self._extra is not None:
+                self._extra.pop(key, None)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if self._extra is None:
+            self._extra = {}
+        if key in self.KEYS:
+            self._extra[key] = _DELETED
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        if self._extra is not None and key in self._extra:
+            return self._extra[key] is not _DELETED
+        return key in self._fields
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        if self._extra is None:
+            return list(self.KEYS)
+        extra = self._extra
+        return [k for k in self.KEYS if extra.get(k) is not _DELETED] + [
+            k for k, v in extra.items() if k not in self.KEYS and v is not _DELETED
+        ]
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def copy(self):
+        return dict(self.items())
+
+
+class LDRStep(SlottedRecord):
+    """A parsed building step of a model as returned by LDRModel.parse_model.
+    A step can be created with a loader function, in which case the fields
+    which are expensive to compute (the PLI and the parts added in the step)
+    are only loaded by calling loader(step) when one of them is accessed."""
+
+    KEYS = (
+        "parts",
+        "sub_models",
+        "aspect",
+        "scale",
+        "model_scale",
+        "raw_ldraw",
+        "step_parts",
+        "pli_bom",
+        "meta",
+        "aspect_change",
+        "sub_parts",
+    )
+    LAZY_KEYS = ("pli", "step_parts", "pli_bom", "sub_parts")
+    # the fields which are stored by the parse cache with each step, the
+    # parts are stored separately and the lazy fields are loaded again
+    CACHED_KEYS = (
+        "sub_models",
+        "aspect",
+        "scale",
+        "model_scale",
+        "raw_ldraw",
+        "meta",
+        "aspect_change",
+    )
+    _fields = frozenset(KEYS)
+    _lazy = frozenset(LAZY_KEYS)
+    __slots__ = KEYS + ("pli", "loader", "context")
+
+    def __init__(self, loader=None, context=None, **kwargs):
+        self._extra = None
+        self.loader = loader
+        self.context = context
+        for k in self.KEYS + ("pli",):
+            if k in kwargs:
+                setattr(self, k, kwargs.pop(k))
+            elif loader is None or k not in self._lazy:
+                setattr(self, k, None)
+        for k, v in kwargs.items():
+            self[k] = v
+
+    def __getattr__(self, key):
+        # only called for the lazy fields which have not been loaded yet
+        if key in LDRStep._lazy and self.loader is not None:
+            self.load()
+            return object.__getattribute__(self, key)
+        raise AttributeError(key)
+
+    @property
+    def is_loaded(self):
+        return self.loader is None
+
+    def load(self):
+        """Loads the lazy fields of the step if they have not been loaded.
+        Lazy fields which have already been assigned are kept."""
+        if self.loader is not None:
+            for k, v in self.loader(self).items():
+                try:
+                    object.__getattribute__(self, k)
+                except AttributeError:
+                    setattr(self, k, v)
+            self.loader = None
+            self.context = None
+
+
+class StepPLI(Mapping):
+    """Read-only mapping of step number to the list of PLI parts of each
+    step.  The PLI is taken from the step records and so is only loaded
+    for lazily parsed steps when it is accessed."""
+
+    def __init__(self, steps):
+        self.steps = steps
+
+    def __getitem__(self, key):
+        return self.steps[key].pli
+
+    def __iter__(self):
+        return iter(self.steps)
+
+    def __len__(self):
+        return len(self.steps)
+
+
+class LDRUnwrappedStep(SlottedRecord):
+    """A step of the unwrapped model as built by LDRModel.unwrap_model.  The
+    step's position in the unwrapped sequence is stored in the record itself
+    while the parts, PLI, meta commands and other heavy fields are shared
+    with the parsed LDRStep it refers to rather than copied.  Assigning a
+    shared field only replaces the value for this unwrapped step."""
+
+    KEYS = (
+        "idx",
+        "level",
+        "step",
+        "next_step",
+        "num_steps",
+        "model",
+        "qty",
+        "scale",
+        "model_scale",
+        "aspect",
+        "parts",
+        "step_parts",
+        "pli_bom",
+        "meta",
+        "aspect_change",
+        "raw_ldraw",
+        "sub_parts",
+        "prev_level",
+        "next_level",
+        "page_break",
+        "no_pli",
+        "callout",
+    )
+    OWN_KEYS = (
+        "idx",
+        "level",
+        "step",
+        "next_step",
+        "num_steps",
+        "model",
+        "qty",
+        "scale",
+        "prev_level",
+        "next_level",
+        "page_break",
+        "no_pli",
+        "callout",
+    )
+    _fields = frozenset(OWN_KEYS)
+    _shared = frozenset(KEYS) - _fields
+    __slots__ = OWN_KEYS + ("source",)
+
+    def __init__(self, source, **kwargs):
+        self._extra = None
+        self.source = source
+        for k in self.OWN_KEYS:
+            setattr(self, k, kwargs.pop(k, None))
+        if self.scale is None:
+            self.scale = source["scale"]
+        for k, v in kwargs.items():
+            self[k] = v
+
+    def __getitem__(self, key):
+        if self._extra is not None and key in self._extra:
+            value = self._extra[key]
+            if value is _DELETED:
+                raise KeyError(key)
+            return value
+        if key in self._fields:
+            return getattr(self, key)
+        if key in self._shared:
+            return self.source[key]
+        raise KeyError(key)
+
+    def __getattr__(self, key):
+        # only called for the shared fields which are not slots
+        if key in LDRUnwrappedStep._shared:
+            try:
+                return self[key]
+            except KeyError:
+                raise AttributeError(key)
+        raise AttributeError(key)
+
+    def __contains__(self, key):
+        if self._extra is not None and key in self._extra:
+            return self._extra[key] is not _DELETED
+        return key in self._fields or key in self._shared
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import os.path
+import sys
+import argparse
+
+from ldrawpy import *
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Display the bill of materials (BOM) of a LDraw file.",
+    )
+    parser.add_argument(
+        "filename",
+        metavar="filename",
+        type=str,
+        nargs="?",
+        help="LDraw or binary part (.ldrparts) filename",
+    )
+    parser.add_argument(
+        "-q",
+        "--quantity",
+        action="store_true",
+        default=False,
+        help="Sort parts by quantity rather than by name",
+    )
+    args = parser.parse_args()
+    argsd = vars(args)
+
+    if len(argsd) < 1 or "filename" not in argsd or argsd["filename"] is None:
+        parser.print_help()
+        exit()
+    if argsd["filename"].lower().endswith(PART_FILE_EXT):
+        with PartFile(argsd["filename"]) as f:
+            counts = f.counts()
+    else:
+        counts = file_part_counts(argsd["filename"])
+    if argsd["quantity"]:
+        keys = sorted(counts, key=lambda k: (-counts[k], k[0], str(k[1])))
+    else:
+        keys = sorted(counts, key=lambda k: (k[0], str(k[1])))
+    for name, colour in keys:
+        print(
+            "%5d x %-20s %4s %s"
+            % (
+                counts[(name, colour)],
+                name,
+                colour,
+                LDRColour.SafeLDRColourName(colour),
+            )
+        )
+    print("%5d parts total, %d unique" % (sum(counts.values()), len(counts)))
+
+
+if __name__ == "__main__":
+    main()
@@ -60,6 +60,7 @@ setuptools.setup(
         "License :: OSI Approved :: MIT License",
     ],
     install_requires=[
+        "numpy",
         "pillow",
         "pytest",
         "rich",
@@ -67,6 +68,7 @@ setuptools.setup(
     entry_points={
         "console_scripts": [
             "ldrcat=ldrawpy.scripts.ldrcat:main",
+            "ldrbom=ldrawpy.scripts.ldrbom:main",
         ]
     }
 )
@@ -0,0 +1,148 @@
+# Sample Test passing with nose and pytest
+
+import os
+import sys
+import pytest
+
+from toolbox import *
+from ldrawpy import *
+
+
+def test_parttable_from_parts():
+    p1 = LDRPart(4, name="3001")
+    p1.attrib.loc = Vector(10, 20, 30)
+    p2 = LDRPart(1, name="3666")
+    p3 = LDRPart(4, name="3001")
+    pt = PartTable.from_parts([p1, p2, p3])
+    assert len(pt) == 3
+    assert pt.categories == ["3001", "3666"]
+    assert list(pt.colours) == [4, 1, 4]
+    assert pt.loc[0][1] == 20
+    assert pt.counts() == {("3001", 4): 2, ("3666", 1): 1}
+    parts = pt.to_parts()
+    assert str(parts[0]) == str(p1)
+    assert str(pt[1]) == str(p2)
+
+
+def test_parttable_slicing():
+    lines = [
+        "1 4 -60 24 50 0 0 -1 0 1 0 1 0 0 3001.dat",
+        "0 STEP",
+        "1 14 50 16 50 0 0 -1 0 1 0 1 0 0 3666.dat",
+        "1 4 60 24 50 0 0 -1 0 1 0 1 0 0 3001.dat",
+    ]
+    pt = PartTable.from_lines(lines)
+    assert len(pt) == 3
+    assert len(pt[1:]) == 2
+    sub = pt.filter(pt.name_mask("3001"))
+    assert len(sub) == 2
+    assert str(sub[1]).rstrip() == lines[3]
+    other = PartTable.from_lines(["1 0 0 0 0 1 0 0 0 1 0 0 0 1 3024.dat"])
+    both = PartTable.concat([pt, other])
+    assert len(both) == 4
+    assert list(both.names) == ["3001", "3666", "3001", "3024"]
+
+
+def test_flatten_model():
+    root_steps, submodels = read_model_parts("./test_files/test_model.ldr")
+    tables = [flatten_model(step, submodels) for step in root_steps]
+    assert sum([len(t) for t in tables]) == 32
+    parts = []
+    for step in root_steps:
+        parts.extend(iter_recursive_parts(step, submodels))
+    flat = PartTable.concat(tables)
+    assert [str(p) for p in flat] == [str(p) for p in parts]
+
+
+def test_flatten_cache():
+    root_steps, submodels = read_model_parts("./test_files/test_model.ldr")
+    cache = FlattenCache()
+    tables = [flatten_model(step, submodels, cache=cache) for step in root_steps]
+    assert sum([len(t) for t in tables]) == 32
+    assert "submodel2.ldr" in cache
+    assert cache.hits > 0
+    submodels["submodel2.ldr"] = submodels["submodel2.ldr"][:1]
+    tables = [flatten_model(step, submodels, cache=cache) for step in root_steps]
+    assert sum([len(t) for t in tables]) == 22
+
+
+def test_cumulative_parts():
+    store = CumulativeParts()
+    s1 = PartTable.from_lines(["1 4 10 0 0 1 0 0 0 1 0 0 0 1 3001.dat"])
+    s2 = PartTable.from_lines(["1 1 0 0 20 1 0 0 0 1 0 0 0 1 3666.dat"])
+    v1 = store.view(store.append(s1), (0, 0, 0))
+    v2 = store.view(store.append(s2), (0, 0, 0))
+    v3 = store.view(len(store), (0, 90, 0))
+    assert len(v1) == 1
+    assert len(v2) == 2
+    assert v2[1].name == "3666"
+    assert v1[0].attrib.loc.x == 10
+    assert len(list(v3)) == 2
+    assert abs(v3[0].attrib.loc.x) < 1e-9
+    end = store.defer(1, lambda: s1)
+    assert len(store) == 3
+    assert len(store.base) == 2
+    assert store.view(end, (0, 0, 0))[2].name == "3001"
+    assert len(store.base) == 3
+
+
+def test_parttable_kernels():
+    pt = PartTable.from_lines(
+        [
+            "1 4 10 0 0 1 0 0 0 1 0 0 0 1 3001.dat",
+            "1 1 0 0 20 0 0 -1 0 1 0 1 0 0 3666.dat",
+        ]
+    )
+    moved = pt.move_to((1, 2, 3))
+    assert list(moved.loc[1]) == [1, 2, 3]
+    assert list(pt.loc[1]) == [0, 0, 20]
+    flat = pt.set_rotation(Identity())
+    assert str(flat[1]).rstrip() == "1 1 0 0 20 1 0 0 0 1 0 0 0 1 3666.dat"
+    assert list(pt.change_colour(15).colours) == [15, 15]
+    assert pt.move_by((0, 8, 0)).loc[0][1] == 8
+
+
+def test_part_file(tmp_path):
+    fn = str(tmp_path / ("test_model" + PART_FILE_EXT))
+    write_model_part_file("./test_files/test_model.ldr", fn)
+    steps = list(iter_flattened_parts("./test_files/test_model.ldr", with_steps=True))
+    with PartFile(fn) as f:
+        assert len(f) == 32
+        assert len(f.steps) == steps[-1][0]
+        assert f.counts() == file_part_counts("./test_files/test_model.ldr")
+        assert [str(p) for p in f.to_parts()] == [str(p) for _, p in steps]
+    model = LDRModel("./test_files/test_model.ldr")
+    model.parse_file(use_cache=False)
+    with PartFile(fn) as f:
+        assert len(f.steps) == len(model.steps)
+        for n, step in model.steps.items():
+            assert len(f.step_table(n)) == len(step["step_parts"])
+            assert len(f.step_table(n, cumulative=True)) == len(step["parts"])
+    # steps which only add PLI proxy parts are stored as empty steps
+    ldr = str(tmp_path / "proxy.ldr")
+    with open(ldr, "w") as fp:
+        fp.write("0 FILE root.ldr\n1 4 0 0 0 1 0 0 0 1 0 0 0 1 3001.dat\n0 STEP\n")
+        fp.write("0 !PY PLI_PROXY 3003_4\n0 STEP\n")
+        fp.write("1 1 0 -24 0 1 0 0 0 1 0 0 0 1 3001.dat\n0 STEP\n")
+    write_model_part_file(ldr, fn)
+    model = LDRModel(ldr)
+    model.parse_file(use_cache=False)
+    with PartFile(fn) as f:
+        assert len(f.steps) == len(model.steps)
+        assert f.steps.tolist() == [1, 1, 2]
+        assert len(f.step_table(2)) == 0
+        assert f.step_table(3)[0].attrib.colour == 1
+        # proxy parts are counted as in the BOM of the parsed model
+        assert f.proxy_counts() == {("3003", 4): 2}
+        assert f.counts() == file_part_counts(ldr)
+        assert f.counts(proxies=False) == {("3001", 4): 1, ("3001", 1): 1}
+    fn = str(tmp_path / "parts.ldrparts")
+    p1 = LDRPart(4, name="3001")
+    p1.move_to((10, -24.5, 0.0001))
+    p2 = LDRPart(1, name="submodel.ldr")
+    p2.wrapcallout = True
+    write_part_file(fn, [[p1], [p1, p2]])
+    with PartFile(fn) as f:
+        assert f.steps.tolist() == [1, 3]
+        assert len(f.step_table(2)) == 2
+        assert "".join([str(p) for p in f.to_parts()]) == str(p1) + str(p1) + str(p2)
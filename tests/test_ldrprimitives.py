@@ -92,3 +92,42 @@ def test_ldrpart_sort():
     assert sp[2].name == "3001"
     assert sp[1].name == "3070b"
     assert sp[0].name == "3666"
+
+
+def test_quantize():
+    assert quantize("1.23456") == 1.2346
+    assert quantize("-59.999975") == -60.0
+    assert quantize("0.00005") == 0.0
+    assert quantize("0.00015") == 0.0002
+    assert quantize(" 12 ") == 12.0
+    assert quantize("1e-5") == 0.0
+
+
+def test_ldrpart_from_str():
+    s = "1 4 -60 24.00004 50 0 0 -1 0 1 0 1 0 0 3001.DAT"
+    p = LDRPart().from_str(s)
+    assert p.name == "3001"
+    assert p.attrib.colour == 4
+    assert p.attrib.loc.y == 24
+    assert str(p).rstrip() == "1 4 -60 24 50 0 0 -1 0 1 0 1 0 0 3001.dat"
+    assert LDRPart().from_str("0 STEP") is None
+    parts = parse_part_lines([s, "0 STEP"])
+    assert parts[0][0] == 4
+    assert parts[0][2] == "3001"
+    assert parts[1] is None
+
+
+def test_ldrpart_shared():
+    s = "1 4 10 -24 0 0 0 1 0 1 0 -1 0 0 3001.dat\n"
+    p1 = LDRPart().from_str(s)
+    p2 = LDRPart().from_str(s)
+    assert p1.attrib.peek_matrix() is p2.attrib.peek_matrix()
+    p3 = p1.copy()
+    p3.attrib.loc.x = 20
+    p3.attrib.matrix.rows[0][0] = 1
+    assert str(p1) == s
+    assert str(p2) == s
+    assert p3.attrib.loc.x == 20
+    p4 = LDRPart()
+    assert p4.attrib.peek_loc().almost_same_as(Vector(0, 0, 0))
+    assert str(p4).startswith("1 16 0 0 0 1 0 0 0 1 0 0 0 1 ")
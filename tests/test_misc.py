@@ -2,7 +2,10 @@
 
 import os
 import sys
+import json
+import pickle
 import pytest
+from collections.abc import MutableMapping
 
 from toolbox import *
 from ldrawpy import *
@@ -21,3 +24,393 @@ def test_cleanup():
         fl = f.read()
         assert len(fl) == 1101
         assert "-60" in fl
+
+
+def test_file_index():
+    idx = LDRFileIndex.from_file("./test_files/test_model.ldr")
+    assert idx.root == "rootmodel.ldr"
+    assert len(idx) == 5
+    assert "submodel2.ldr" in idx
+    steps = idx.step_texts("submodel1.ldr")
+    assert len(steps) == 3
+    assert steps[0].startswith("0 FILE submodel1.ldr")
+    assert "0 STEP" not in steps[1]
+
+
+def test_flattened_parts():
+    fn = "./test_files/test_model.ldr"
+    parts = list(iter_flattened_parts(fn))
+    assert len(parts) == 32
+    assert not any(p.name.endswith(".ldr") for p in parts)
+    with open(fn, "r") as fp:
+        steps = [s for s, _ in iter_flattened_parts(fp, with_steps=True)]
+    assert len(steps) == 32
+    assert steps[-1] == 10
+
+
+def test_flattened_proxy_steps(tmp_path):
+    fn = str(tmp_path / "proxy.ldr")
+    with open(fn, "w") as fp:
+        fp.write("0 FILE root.ldr\n1 4 0 0 0 1 0 0 0 1 0 0 0 1 3001.dat\n0 STEP\n")
+        fp.write("0 !PY PLI_PROXY 3003_4\n0 STEP\n")
+        fp.write("1 1 0 -24 0 1 0 0 0 1 0 0 0 1 3001.dat\n0 STEP\n")
+    steps = [s for s, _ in iter_flattened_parts(fn, with_steps=True)]
+    assert steps == [1, 3]
+    model = LDRModel(fn)
+    model.parse_file(use_cache=False)
+    assert sorted(model.steps) == [1, 2, 3]
+
+
+def test_special_tokens():
+    metas = parse_special_tokens("0 ROTSTEP 10 20 30 ABS")
+    assert metas == [
+        {
+            "rotation_abs": {
+                "values": ["10", "20", "30"],
+                "text": "0 ROTSTEP 10 20 30 ABS",
+            }
+        }
+    ]
+    assert parse_special_tokens("0 !PY BOM")[0]["bom"]["text"] == "0 !PY BOM"
+    assert parse_special_tokens("0 // comment") == []
+    matcher = MetaCommandMatcher()
+    matcher.register("test_widget", "!PY TEST_WIDGET %3")
+    metas = matcher.match("0 !PY TEST_WIDGET 42")
+    assert metas[0]["test_widget"]["values"] == ["42"]
+    assert "test_widget" not in SPECIAL_TOKENS
+    assert parse_special_tokens("0 !PY TEST_WIDGET 42") == []
+    matcher = MetaCommandMatcher({"any_value": ["%1"]})
+    assert matcher.match("0 FOO")[0]["any_value"]["values"] == ["FOO"]
+
+
+def test_callout_index():
+    callouts = {
+        2: {"level": 1, "end": 4, "parent": 0},
+        3: {"level": 2, "end": 3, "parent": 1},
+    }
+    unwrapped = [{"meta": []} for _ in range(6)]
+    unwrapped[4]["meta"] = [{"callout_bottom": {"text": "0 !CALLOUT BOTTOM"}}]
+    ix = CalloutIndex(callouts, unwrapped)
+    assert ix.is_end(4)
+    assert ix.is_end(3)
+    assert not ix.is_end(2)
+    assert ix.parent(3) == 1
+    assert ix.parent(5) == 0
+    assert ix.in_level(3, 1)
+    assert ix.has_meta(2, "callout_bottom")
+    assert not ix.has_meta(5, "callout_bottom")
+
+
+def test_unwrapped_index():
+    unwrapped = [
+        {"idx": 0, "step": 1, "level": 1, "callout": 0, "model": "sub.ldr", "meta": []},
+        {"idx": 1, "step": 1, "level": 0, "callout": 0, "model": "root", "meta": []},
+        {
+            "idx": 2,
+            "step": 2,
+            "level": 0,
+            "callout": 0,
+            "model": "root",
+            "meta": [{"scale": {"values": ["0.5"]}}, {"scale": {"values": ["0.8"]}}],
+        },
+    ]
+    ix = UnwrappedIndex(unwrapped)
+    assert ix.step_idx(1) == 1
+    assert ix.step_idx(1, in_callouts=True) == 0
+    assert ix.step_idx(3) is None
+    assert ix.model_last_idx("root") == 2
+    assert ix.model_last_idx("other.ldr") == 0
+    assert ix.model_meta_idx("root", "scale") == 2
+    assert ix.meta(2, "scale")["scale"]["values"] == ["0.5"]
+    assert ix.meta_count(2, "scale") == 2
+    assert not ix.has_meta(0, "scale")
+
+
+def test_step_records():
+    step = LDRStep(parts=[], meta=[{"page_break": {"text": "0 !PY PAGE_BREAK"}}])
+    step["scale"] = 0.5
+    u = LDRUnwrappedStep(step, idx=0, level=0, step=1, model="root", qty=0)
+    assert u["scale"] == 0.5
+    assert u["meta"] is step["meta"]
+    assert "sub_parts" in u
+    assert "sub_models" not in u
+    d = {**u}
+    assert d["model"] == "root"
+    u["page_break"] = True
+    assert u.page_break
+    # records are mutable mappings like the dictionaries they replace
+    assert isinstance(step, MutableMapping)
+    step.update(scale=0.8, note="x")
+    assert step.pop("note") == "x"
+    assert "note" not in step
+    assert step.setdefault("raw_ldraw", "") is None
+    del u["meta"]
+    assert "meta" not in u
+    assert step["meta"][0]["page_break"]
+    assert len(u) == len(u.keys()) == len(LDRUnwrappedStep.KEYS) - 1
+    u["meta"] = []
+    assert u["meta"] == []
+    assert json.loads(json.dumps(dict(u)))["model"] == "root"
+
+
+def test_lazy_step():
+    def loader(step):
+        return {"pli": [], "step_parts": ["1"], "pli_bom": None, "sub_parts": {}}
+
+    step = LDRStep(loader=loader, parts=[], meta=[], sub_models=[])
+    assert not step.is_loaded
+    assert step["meta"] == []
+    assert not step.is_loaded
+    assert step["step_parts"] == ["1"]
+    assert step.is_loaded
+    assert StepPLI({1: step})[1] == []
+
+
+def test_lazy_parse():
+    fn = "./test_files/test_model.ldr"
+    model = LDRModel(fn, lazy=True)
+    model.parse_file(use_cache=False)
+    eager = LDRModel(fn)
+    eager.parse_file(use_cache=False)
+    assert len(model.steps) == len(eager.steps)
+    store = model.steps[1]["parts"].store
+    # no parts are flattened or steps loaded until they are accessed
+    assert len(store.base) == 0
+    assert not any([step.is_loaded for step in model.steps.values()])
+    parts = model.steps[4]["parts"]
+    assert [str(p) for p in parts] == [str(p) for p in eager.steps[4]["parts"]]
+    assert len(store.base) == parts.end
+    assert len(store.base) < len(store)
+    assert not model.steps[4].is_loaded
+    assert [str(p) for p in model.pli[6]] == [str(p) for p in eager.pli[6]]
+    assert not model.steps[9].is_loaded
+
+
+def test_parse_cache(tmp_path):
+    cache = ParseCache(str(tmp_path), max_bytes=1 << 20)
+    h = file_hash("./test_files/test_model.ldr")
+    key = ParseCache.key(h, {"global_scale": 1.0})
+    assert not key == ParseCache.key(h, {"global_scale": 0.5})
+    assert cache.load(key) is None
+    cache.store(key, {"callouts": {2: {"level": 1, "end": 4, "parent": 0}}})
+    assert key in cache
+    assert cache.load(key)["callouts"][2]["end"] == 4
+    # an entry pickled with a class which no longer exists is removed
+    with open(cache.filename(key), "wb") as fp:
+        fp.write(b"cldrawpy_missing_module\nMissingClass\n.")
+    assert cache.load(key) is None
+    assert key not in cache
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_model_cache(tmp_path):
+    fn = "./test_files/test_model.ldr"
+    cold = LDRModel(fn, cache_dir=str(tmp_path))
+    cold.parse_file()
+    assert len(ParseCache(str(tmp_path))) == 1
+    warm = LDRModel(fn, cache_dir=str(tmp_path))
+    warm.parse_file()
+    # steps are restored without their PLI and step parts which are only
+    # loaded again when they are accessed
+    assert not any([step.is_loaded for step in warm.steps.values()])
+    assert len(warm.unwrapped) == len(cold.unwrapped)
+    for a, b in zip(warm.unwrapped, cold.unwrapped):
+        assert a["idx"] == b["idx"] and a["model"] == b["model"]
+        assert [str(p) for p in a["parts"]] == [str(p) for p in b["parts"]]
+        assert [str(p) for p in a["step_parts"]] == [str(p) for p in b["step_parts"]]
+    assert [str(p) for p in warm.pli[6]] == [str(p) for p in cold.pli[6]]
+    assert str(warm.bom) == str(cold.bom)
+
+
+def test_submodel_graph():
+    counts = file_part_counts("./test_files/test_model.ldr")
+    assert sum(counts.values()) == 32
+    assert counts[("99781", 0)] == 5
+    assert counts[("85984", 19)] == 2
+    line = "1 16 0 0 0 1 0 0 0 1 0 0 0 1 %s"
+    subs = {
+        "a.ldr": [{"ldrtext": line % ("b.ldr"), "partname": "b.ldr"}],
+        "b.ldr": [{"ldrtext": line % ("a.ldr"), "partname": "a.ldr"}],
+    }
+    with pytest.raises(ValueError):
+        SubmodelGraph(subs)
+
+
+def test_proxy_part_counts(tmp_path):
+    ldr = str(tmp_path / "proxy.ldr")
+    with open(ldr, "w") as fp:
+        fp.write("0 FILE root.ldr\n")
+        fp.write("1 16 0 0 0 1 0 0 0 1 0 0 0 1 sub.ldr\n")
+        fp.write("1 16 0 -24 0 1 0 0 0 1 0 0 0 1 sub.ldr\n")
+        fp.write("0 !PY PLI_PROXY 3003_4\n0 STEP\n0 NOFILE\n")
+        fp.write("0 FILE sub.ldr\n1 1 0 0 0 1 0 0 0 1 0 0 0 1 3001.dat\n")
+        fp.write("0 !PY PLI_PROXY 3004_1\n0 STEP\n")
+        fp.write("0 !PY PLI_PROXY 3005_2\n0 STEP\n0 NOFILE\n")
+    # proxy parts are counted as they are by the BOM of LDRModel, i.e. the
+    # root step proxies when parsed and unwrapped, and the submodel step
+    # proxies once per root step which unwraps the submodel
+    counts = file_part_counts(ldr)
+    assert counts == {("3001", 1): 2, ("3003", 4): 2, ("3004", 1): 1, ("3005", 2): 1}
+
+
+def test_structural_hash():
+    def part(line):
+        return {"ldrtext": line, "partname": " ".join(line.split()[14:]).lower()}
+
+    subs = {
+        "wheel.ldr": [
+            part("1 0 0 0 0 1 0 0 0 1 0 0 0 1 3482.dat"),
+            part("1 0 0 0 10 1 0 0 0 1 0 0 0 1 3483.dat"),
+        ],
+        "wheel_copy.ldr": [
+            part("1 0 0 0 10.00001 1 0 0 0 1 0 0 0 1 3483.DAT"),
+            part("1 0 0 0 0 1 0 0 0 1 0 0 0 1 3482.dat"),
+        ],
+        "wheel2.ldr": [
+            part("1 0 0 0 0 1 0 0 0 1 0 0 0 1 3482.dat"),
+            part("1 0 0 0 10.00001 1 0 0 0 1 0 0 0 1 3483.DAT"),
+        ],
+        "axle1.ldr": [part("1 16 20 0 0 1 0 0 0 1 0 0 0 1 wheel.ldr")],
+        "axle2.ldr": [part("1 16 20 0 0 1 0 0 0 1 0 0 0 1 wheel_copy.ldr")],
+        "axle3.ldr": [part("1 16 20 0 0 1 0 0 0 1 0 0 0 1 wheel2.ldr")],
+    }
+    graph = SubmodelGraph(subs)
+    assert graph.hashes["wheel.ldr"] == graph.hashes["wheel_copy.ldr"]
+    assert graph.hashes["axle1.ldr"] == graph.hashes["axle2.ldr"]
+    assert not graph.hashes["wheel.ldr"] == graph.hashes["axle1.ldr"]
+    # only submodels with their parts in the same order are aliased
+    aliases = graph.aliases()
+    assert aliases == {"wheel2.ldr": "wheel.ldr", "axle3.ldr": "axle1.ldr"}
+
+
+def test_dedup_submodels():
+    fn = "./test_files/test_dedup.ldr"
+    models = []
+    for dedup in [False, True]:
+        model = LDRModel(fn, dedup_submodels=dedup)
+        model.parse_file(use_cache=False)
+        models.append(model)
+    for model in models:
+        idx = model.get_sub_model_assem("rim_copy.ldr")
+        assert model.unwrapped[idx]["model"] == "rim_copy.ldr"
+        assert idx > model.get_sub_model_assem("wheel.ldr")
+        assert model.get_sub_model_assem("rim.ldr") < model.get_sub_model_assem(
+            "wheel.ldr"
+        )
+        idx = model.get_sub_model_assem("wheel_copy.ldr")
+        assert "rim_copy.ldr" in model.unwrapped[idx]["raw_ldraw"]
+        assert model.model_has_meta("wheel_copy.ldr", "scale")
+    u1, u2 = [model.unwrapped for model in models]
+    assert [e["model"] for e in u1] == [e["model"] for e in u2]
+    assert [e["raw_ldraw"] for e in u1] == [e["raw_ldraw"] for e in u2]
+    parts = [[[str(p) for p in e["step_parts"]] for e in u] for u in [u1, u2]]
+    assert parts[0] == parts[1]
+
+
+def test_rotation_cache():
+    cache = RotationCache(max_size=2)
+    e1 = cache.get((0, 90, 0), lambda: euler_to_rot_matrix((0, 90, 0)))
+    e2 = cache.get((0, 90, 0), lambda: euler_to_rot_matrix((0, 90, 0)))
+    assert e1 is e2
+    assert cache.hits == 1
+    assert cache.misses == 1
+    assert not e1.array.flags.writeable
+    cache.get((10, 0, 0), lambda: euler_to_rot_matrix((10, 0, 0)))
+    cache.get((20, 0, 0), lambda: euler_to_rot_matrix((20, 0, 0)))
+    assert len(cache) == 2
+    assert cache.stats()["hit_rate"] == 0.25
+    m1 = rotation_matrix((-40, 55, 0))
+    m2 = rotation_matrix((-40, 55, 0))
+    assert m1.rows == m2.rows
+    assert m1 is not m2
+
+
+def test_part_aliases(tmp_path):
+    assert PART_ALIASES.lookup("3794a") == "15573"
+    assert PART_ALIASES.lookup("ls02") is None
+    aliases = PartAliases([("a", "b")], ignore=["C"])
+    aliases.add("b", "c.dat")
+    assert aliases.resolve("a") == "c"
+    assert aliases.lookup("a") is None
+    with pytest.raises(ValueError):
+        aliases.add("c", "a")
+    fn = tmp_path / "aliases.txt"
+    fn.write_text("# user aliases\nx1, x2\nx2 x3\n")
+    assert aliases.load(str(fn)) == 2
+    assert aliases.resolve("x1") == "x3"
+    parts = tmp_path / "parts"
+    parts.mkdir()
+    (parts / "3794.dat").write_text("0 ~Moved to 15573\n")
+    (parts / "3001.dat").write_text("0 Brick  2 x  4\n")
+    assert aliases.scan_library(str(tmp_path)) == 1
+    assert aliases.resolve("3794") == "15573"
+    # aliases are pickled without their lookup cache
+    aliases.exceptions.add("3001.dat")
+    copied = pickle.loads(pickle.dumps(aliases))
+    assert copied.digest() == aliases.digest()
+    assert copied._resolved == {}
+    text = (
+        "0 LPUB PLI BEGIN IGN\n1 4 0 0 0 1 0 0 0 1 0 0 0 1 3001.dat\n0 LPUB PLI END\n"
+    )
+    assert len(scan_ldraw(text, aliases=copied)[0]) == 1
+    assert len(scan_ldraw(text)[0]) == 0
+    # a batch of aliases is only added if all of them are valid
+    before = aliases.digest()
+    with pytest.raises(ValueError):
+        aliases.update([("y1", "y2"), ("x3", "x1")])
+    assert aliases.digest() == before
+    assert aliases.lookup("y1") == "y1"
+    fn.write_text("y1 y2\ny2\n")
+    with pytest.raises(ValueError):
+        aliases.load(str(fn))
+    assert "y1" not in aliases
+
+
+def test_print_step_dict(capsys):
+    model = LDRModel("./test_files/test_model.ldr")
+    model.parse_file(use_cache=False)
+    model.print_step_dict(1)
+    model.print_unwrapped_dict(0)
+    out = capsys.readouterr().out
+    assert "CumulativePartsView" not in out
+    assert str(model.steps[1]["parts"][0]).rstrip() in out
+
+
+def test_step_parts_helpers():
+    model = LDRModel("./test_files/test_model.ldr")
+    model.parse_file(use_cache=False)
+    parts = model.steps[4]["parts"]
+    assert len(parts) > 1
+    assert [str(p) for p in ldrlist_from_parts(parts)] == [str(p) for p in parts]
+    assert len(merge_same_parts(parts, [])) == len(parts)
+    assert len(remove_parts_from_list(parts, [])) == len(parts)
+    removed = remove_parts_from_list(parts, parts[:1])
+    assert [str(p) for p in removed] == [
+        str(p) for p in parts if not p.name == parts[0].name
+    ]
+    unwrapped = model.unwrapped[0]["parts"]
+    assert len(ldrlist_from_parts(unwrapped)) == len(unwrapped)
+
+
+def test_part_alias_lists(tmp_path):
+    from ldrawpy.ldrmodel import IGNORE_LIST, COMMON_SUBSTITUTIONS
+
+    ldr = str(tmp_path / "ignore.ldr")
+    with open(ldr, "w") as fp:
+        fp.write("0 FILE root.ldr\n1 4 0 0 0 1 0 0 0 1 0 0 0 1 3001.dat\n")
+        fp.write("1 1 0 -24 0 1 0 0 0 1 0 0 0 1 3003.dat\n")
+    assert file_part_counts(ldr) == {("3001", 4): 1, ("3003", 1): 1}
+    # changes to the alias lists are applied when a file is parsed
+    IGNORE_LIST.append("3001")
+    COMMON_SUBSTITUTIONS.append(("3003", "3004"))
+    try:
+        assert file_part_counts(ldr) == {("3004", 1): 1}
+        model = LDRModel(ldr)
+        model.parse_file(use_cache=False)
+        assert [p.name for p in model.steps[1]["parts"]] == ["3004"]
+    finally:
+        IGNORE_LIST.remove("3001")
+        COMMON_SUBSTITUTIONS.remove(("3003", "3004"))
+    assert file_part_counts(ldr) == {("3001", 4): 1, ("3003", 1): 1}
+    assert PART_ALIASES.lookup("3070a") == "3070b"